@@ -10,20 +10,22 @@ from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 import smtplib
 import threading
-
-## Grab the backported enums from python3.4
+from collections import OrderedDict
 from enum import Enum
 
 import piggyphoto
+from preview import PreviewWorker, TransformPlan
+from effects import EffectPipeline
+from capture import CaptureWorker, CardKeeper, capture_mode_profile
+from strip import StripService, TemplateCache, LAYOUTS
+from timing import FrameGovernor, Timings
 import pygame
 from pygame.locals import *
 import easygui
-import PIL
+import PIL.Image
 import serial
 import numpy
-from scipy import ndimage
 
-PREVIEW = '/mnt/tmp/preview.jpg'
 STORE_DIR = 'images'
 SAVE_PREFIX = 'Booth'
 STRIP_SUFFIX = 'Strip'
@@ -32,8 +34,13 @@ FROM_ADDR = 'auto-mailer@newport.net.nz'
 SERIAL = '/dev/ttyACM0'
 READY_WAIT = 5  # seconds for the 'Get Ready!' prompt
 COUNTDOWN_WAIT = 1  # seconds between 3..2..1
+FLASH_TIME = 0.2  # seconds the screen flashes white when a photo is taken
 SHOT_COUNT = 3
+WARMUP_ATTEMPTS = 3  # tries at the first preview before giving up on the camera
+WARMUP_RETRY_WAIT = 0.5  # seconds between them
 SCRIPT_DIR = './'
+ATTRACT_EFFECTS = ('blur', 'dim', 'vignette')
+SHOOT_FPS = 30  # Target frame rate while counting down, the governor backs off from here if it has to
 
 
 class BoothState(Enum):
@@ -59,17 +66,49 @@ class ShootPhase(Enum):
         return ShootPhase(self.value - 1)
 
 
+class TextCache(object):
+    """LRU cache of rendered text, with the outline already composited in.
+
+    Each entry is a (surface, position) pair centered on the screen, so drawing
+    cached text is a single blit.
+    """
+    def __init__(self, screen_size, size=32):
+        self.screen_size = screen_size
+        self.size = size
+        self._entries = OrderedDict()
+
+    def get(self, text, font, color, outline):
+        key = (text, font, color, outline)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            entry = self.render(text, font, color, outline)
+            if len(self._entries) >= self.size:
+                self._entries.popitem(last=False)
+        self._entries[key] = entry
+        return entry
+
+    def render(self, text, font, color, outline):
+        textobj = font.render(text, True, color)
+        if outline:
+            (width, height) = textobj.get_size()
+            composite = pygame.Surface((width + 2, height + 2), pygame.SRCALPHA)
+            shadow = font.render(text, True, (0, 0, 0))
+            for xoffset in (0, 2):
+                for yoffset in (0, 2):
+                    composite.blit(shadow, (xoffset, yoffset))
+            composite.blit(textobj, (1, 1))
+            textobj = composite
+        textobj = textobj.convert_alpha()
+        textpos = textobj.get_rect(centerx=self.screen_size[0] / 2, centery=self.screen_size[1] / 2)
+        return (textobj, textpos)
+
+
 class BoothView(object):
-    def __init__(self, width=900, height=768, fps=5, fullscreen=True):
+    def __init__(self, width=900, height=768, fps=15, fullscreen=True, camera=None, profiles=None,
+                 capture_mode='ram', archive=False, card_keep=50, layout='portrait'):
         """Initialize the bits"""
         pygame.init()
         pygame.display.set_caption(CAPTION)
-        dir = os.path.dirname(PREVIEW)
-        if not os.access(dir, os.W_OK):
-            print 'Directory {} is not writable. Ensure it exists and is writable.\n'.format(dir)
-            print 'Try `mount -t tmpfs -o size=100m tmpfs {}` to create a ramdisk in that location\n'.format(dir)
-            pygame.quit()
-            sys.exit()
         self.width = width
         self.height = height
         self.screen = None
@@ -82,23 +121,84 @@ class BoothView(object):
         self.background = pygame.Surface(self.screen.get_size()).convert()
         self.clock = pygame.time.Clock()
         self.base_fps = fps
-        self.fps = fps
+        self.timings = Timings()
+        self.governor = FrameGovernor(self.timings, target_fps=fps)
+        self.show_hud = False
         self.countdown = READY_WAIT
         self.small_font = pygame.font.SysFont('Arial', 20, bold=True)
         self.large_font = pygame.font.SysFont('Arial', 40, bold=True)
         self.huge_font = pygame.font.SysFont('Arial', 150, bold=True)
+        self.text_cache = TextCache(self.background.get_size())
 
-        self.camera = piggyphoto.camera()
+        self.camera = camera if camera is not None else piggyphoto.camera()
         self.camera.leave_locked()
-        self.camera.capture_preview(PREVIEW)
+        # The layout says how the camera is mounted, the preview is turned the same way as the photos
+        self.rotation = LAYOUTS[layout].rotation
+        self.preview = PreviewWorker(self.camera, fit_width=self.width, rotation=self.rotation,
+                                     timings=self.timings)
+        # The first preview after connecting can fail on some Canons, get it out of the way
+        for attempt in range(WARMUP_ATTEMPTS):
+            try:
+                self.preview.capture_data()
+                break
+            except piggyphoto.libgphoto2error as e:
+                if attempt == WARMUP_ATTEMPTS - 1:
+                    raise
+                print('Warm-up preview failed, trying again: {}'.format(e))
+                time.sleep(WARMUP_RETRY_WAIT)
+        # Before the preview worker starts, so nothing else is talking to the camera yet
+        (capture_profile, files_per_shot) = capture_mode_profile(self.camera, capture_mode, archive)
+        if capture_profile is not None:
+            print('Capture mode {}: {}'.format(capture_mode, capture_profile.settings))
+            self.camera.apply_profile(capture_profile)
+        self.preview.start()
+        # Shots taken into RAM never reach the card, so there's nothing to tidy up
+        keeper = None
+        if card_keep is not None and (capture_mode == 'card' or archive):
+            keeper = CardKeeper(self.camera, keep=card_keep, path=os.path.join(STORE_DIR, 'card.json'))
+        self.capture = CaptureWorker(self.camera, self.preview.camera_lock, timings=self.timings,
+                                     files_per_shot=files_per_shot, keeper=keeper)
+        self.capture.start()
+        # Filenames handed to the capture worker this session, and the indexes it has finished with
+        self.submitted = {}
+        self.shots_done = set()
+        self.flash_until = 0
+        self.picture = None
+        self.picture_key = None
+        self.attract_effects = EffectPipeline(ATTRACT_EFFECTS)
+
+        # Camera profiles applied on the way into a state, keyed 'attract' and 'shoot'
+        self.profiles = profiles or {}
+        if capture_profile is not None:
+            # The capture mode decides these, a saved profile mustn't switch them back
+            for profile in self.profiles.values():
+                for setting in list(profile.settings):
+                    if setting.split('.')[-1] in capture_profile.settings:
+                        print('Profile {} leaves {} to the capture mode'.format(profile.name, setting))
+                        del profile.settings[setting]
+        self.apply_profile('attract')
 
         self.state = BoothState.waiting
         self.shoot_phase = ShootPhase.get_ready
         self.phase_start = time.time()
+        self.session_start = self.phase_start
         self.shots_left = SHOT_COUNT
         self.shot_counter = 0
         self.session_counter = 1
         self.images = []
+        self.strip = None
+        # Decode the strip templates now rather than in the middle of a session
+        self.templates = TemplateCache()
+        self.templates.preload([os.path.join(SCRIPT_DIR, each.template) for each in LAYOUTS.values()])
+        self.strip_plan = LAYOUTS[layout].compile(self.templates, SHOT_COUNT, SCRIPT_DIR)
+        self.strips = StripService(templates=[self.strip_plan.template], timings=self.timings)
+        self.strips.start()
+        # Per session: how far its strip has got, the finished strip, and who to email it to
+        self.rendering = {}
+        self.strip_files = {}
+        self.emails = {}
+        self.mockup = self.make_mockup()
+        self.shot_frames = []
         self.pid = os.getpid()
 
     def run(self):
@@ -110,12 +210,28 @@ class BoothView(object):
                 elif event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
                         running = False
+                    elif event.key == pygame.K_F1:
+                        self.show_hud = not self.show_hud
+                    elif event.key == pygame.K_F2:
+                        self.dump_timings()
                     elif event.key == pygame.K_RETURN and self.state == BoothState.waiting:
                         self.switch_state(BoothState.shooting)
                 elif event.type == pygame.USEREVENT:
                     if event.action == 'button_pressed' and self.state == BoothState.waiting:
                         print('Actioning event from serial')
                         self.switch_state(BoothState.shooting)
+                    elif event.action in ('capture_complete', 'capture_failed'):
+                        if event.index in self.shots_done or self.submitted.get(event.index) != event.filename:
+                            print('Ignoring {} for {}, not a shot still waiting'.format(event.action, event.filename))
+                        elif event.action == 'capture_complete':
+                            self.shots_done.add(event.index)
+                            self.images[event.index] = event.filename
+                            self.strip.add(event.index, event.filename)
+                        else:
+                            self.shots_done.add(event.index)
+                            self.strip.skip(event.index)
+                    elif event.action.startswith('strip_'):
+                        self.strip_event(event)
             if not running:
                 break
             if self.state == BoothState.waiting:
@@ -128,10 +244,25 @@ class BoothView(object):
                 # Just quit for now
                 self.switch_state(BoothState.waiting)
 
-            self.clock.tick(self.fps)
-            pygame.display.set_caption("{} FPS: {:6.3}".format(CAPTION, self.clock.get_fps()))
-            pygame.display.flip()
+            if self.show_hud:
+                self.draw_hud()
+            self.clock.tick(self.governor.fps)
+            pygame.display.set_caption("{} FPS: {:6.3} Quality: {}".format(CAPTION, self.clock.get_fps(),
+                                                                          self.governor.quality))
+            with self.timings.span('flip'):
+                pygame.display.flip()
+            if self.governor.adjust():
+                self.preview.fit_width = int(self.width * self.governor.quality)
         print('Exiting main loop')
+        self.preview.stop()
+        self.capture.stop()
+        # Let the strips still rendering finish, and send the emails that were waiting on them
+        self.strips.stop()
+        self.strips.join()
+        for event in pygame.event.get(pygame.USEREVENT):
+            if event.action.startswith('strip_'):
+                self.strip_event(event)
+        self.dump_timings()
         pygame.quit()
 
     def wait_state(self):
@@ -152,26 +283,34 @@ class BoothView(object):
                     filename = os.path.join(STORE_DIR, '{0}{1}-{2:04d}{3:02d}.jpg'.format(SAVE_PREFIX, self.pid,
                                                                                           self.session_counter,
                                                                                           self.shot_counter))
-                    self.camera.capture_image(filename)
-                    self.images.append(filename)
+                    # The capture worker shoots and downloads, we carry on with the next countdown
+                    index = SHOT_COUNT - self.shots_left
+                    self.capture.submit(index, filename)
+                    # What the preview showed as the shutter went, standing in for the photo in the mock-up
+                    self.shot_frames[index] = self.preview.slot.latest()[1]
+                    self.submitted[index] = filename
+                    self.flash_until = frame_time + FLASH_TIME
                     self.shot_counter += 1
                     self.shots_left -= 1
                     self.shoot_phase = next(self.shoot_phase)
-                    # Add a double time to allow for the shot time
-                    self.countdown = COUNTDOWN_WAIT * 2
-                    if self.shots_left == 0:
-                        self.switch_state(BoothState.email)
-                        return
+                    self.countdown = COUNTDOWN_WAIT
+        if frame_time < self.flash_until:
+            self.screen.fill((255, 255, 255))
+            return
+        if self.shots_left == 0:
+            if len(self.shots_done) == SHOT_COUNT:
+                self.switch_state(BoothState.email)
+            else:
+                self.draw_mockup()
+                self.draw_centered_text('Processing...', self.large_font, outline=True)
+            return
         if self.shoot_phase == ShootPhase.get_ready:
             self.draw_centered_text('Get Ready!', self.huge_font, outline=True)
         elif self.shoot_phase != ShootPhase.shoot:
             self.draw_centered_text(str(self.shoot_phase.value), self.huge_font, outline=True)
 
     def collect_email(self):
-        start = time.time()
-        strip_file = self.generate_strip()
-        finish = time.time()
-        print(('Strip generation started {0}, finished {1}, elapsed {2}. Output {3}'.format(start, finish, finish - start, strip_file)))
+        # The strip is still rendering in the pool, it gets sent whenever it turns up
         if self.fullscreen:
             pygame.display.toggle_fullscreen()
         email = easygui.enterbox(
@@ -186,9 +325,9 @@ class BoothView(object):
         elif email in ('null@catalyst.net.nz', ''):
             send_email = False
 
-        if send_email:
-            email_thread = threading.Thread(target=BoothView.send_strip, args=[email, strip_file])
-            email_thread.start()
+        # None when there's nothing to send, so the strip isn't kept waiting for an address
+        self.emails[self.session_counter] = email if send_email else None
+        self.send_when_ready(self.session_counter)
 
         if self.fullscreen:
             pygame.display.toggle_fullscreen()
@@ -196,60 +335,72 @@ class BoothView(object):
 
     def update_image(self, source=None, blur=False):
         if source is None:
-            camera_file = self.camera.capture_preview()
-            camera_file.save(PREVIEW)
-            camera_file.__dealoc__(PREVIEW)
-
-        picture = pygame.image.load(PREVIEW)
-        picture = pygame.transform.rotate(picture, -90)
-        (width, height) = picture.get_size()
-        new_height = self.width*(float(height)/width)
-        #new_height = 800*(float(height)/width)
-        picture = pygame.transform.scale(picture, (self.width, int(new_height)))
-        #picture = pygame.transform.scale(picture, (800, int(new_height)))
-        # Smoothscale looks better, but is a ~30% speed hit
-        # picture = pygame.transform.smoothscale(picture, (int(new_width), self.height))
-        tb_crop = (new_height - self.height)/2.0
-        if blur:
-            surface_array = pygame.surfarray.pixels3d(picture)
-            # Do the resize simultaneously with adding the shade
-            if tb_crop > 0:
-                surface_array = surface_array[tb_crop:-tb_crop] / 2  # Gives appearance of dark overlay, ~30% speed hit
-            else:
-                surface_array = surface_array / 2
-            tb_crop = 0
-            # sigma = 3
-            # Nice blur effect, but ~75% speed hit
-            # surface_array = ndimage.filters.gaussian_filter(
-            #     surface_array,
-            #     sigma=(sigma, sigma, 0),
-            #     order=0,
-            #     mode='reflect'
-            # )
-            picture = pygame.surfarray.make_surface(surface_array)
-        #self.screen.blit(picture, (0, -tb_crop))
-        self.screen.blit(picture, (0, -tb_crop))
-
-    def generate_strip(self):
-        canvas = PIL.Image.open(os.path.join(SCRIPT_DIR, 'photobooth_template_portrait.jpg'))
-        i = 0
-        piece_dims = (833, 533)
-        piece_dims = (533, 833)
-        for pos in [(60,60), (607,60), (60,907)]:
-            img = PIL.Image.open(self.images[i])
-            img = img.rotate(-90)
-            # Snip the top and bottom strips so it's the right proportion
-            (dims, crop) = get_resize_transform(img.size, piece_dims)
-            img = img.resize(dims, resample=PIL.Image.ANTIALIAS)
-            img = img.crop((crop[0]/2, crop[1]/2, piece_dims[0]+crop[0]/2,  piece_dims[1]+crop[1]/2))
-            canvas.paste(img, box=pos)
-            i += 1
-        strip_file = os.path.join(STORE_DIR, '{0}{1}-{2:04d}-{3}.jpg'.format(SAVE_PREFIX, self.pid, self.session_counter, STRIP_SUFFIX))
-        canvas.save(strip_file)
-        return strip_file
+            (sequence, source) = self.preview.slot.latest()
+            if source is None:
+                # Nothing from the camera yet
+                self.screen.fill((0, 0, 0))
+                return
+            if self.picture is not None and self.picture_key == (sequence, blur):
+                # No new frame since the last draw, reuse what we prepared last time. Nothing is
+                # recorded, zeros would drag down the averages the governor works from
+                self.screen.blit(*self.picture)
+                return
+            self.picture_key = (sequence, blur)
+
+        with self.timings.span('transform'):
+            plan = TransformPlan.get(source.get_size(), (self.width, self.height), self.rotation)
+            (picture, position) = plan.apply(source)
+        with self.timings.span('effects'):
+            if blur:
+                # Effects work in place on the plan's surface, it gets redrawn from the next frame anyway
+                self.attract_effects(picture, self.governor.effect_budget)
+        self.picture = (picture, position)
+        self.screen.blit(*self.picture)
+
+    def make_mockup(self):
+        """The strip plan scaled to the screen, with a matching thumbnail of its template"""
+        plan = self.strip_plan.scaled((self.width, self.height))
+        template = self.templates.load(plan.template).convert('RGB').resize(plan.size, PIL.Image.LANCZOS)
+        surface = pygame.image.fromstring(template.tobytes(), plan.size, 'RGB').convert()
+        position = ((self.width - plan.size[0]) // 2, (self.height - plan.size[1]) // 2)
+        return (plan, surface, position)
+
+    def draw_mockup(self):
+        """Sketch of the strip on its way, from the preview frames caught as each shot was taken"""
+        (plan, template, (left, top)) = self.mockup
+        self.screen.blit(template, (left, top))
+        for (frame, (x, y, width, height)) in zip(self.shot_frames, plan.slots):
+            if frame is None:
+                continue
+            (picture, (dx, dy)) = TransformPlan.get(frame.get_size(), (width, height), plan.rotation).apply(frame)
+            self.screen.blit(picture, (left + x + dx, top + y + dy))
+
+    def strip_event(self, event):
+        if event.action == 'strip_progress':
+            self.rendering[event.session] = (event.done, event.total)
+        elif event.action == 'strip_ready':
+            self.rendering.pop(event.session, None)
+            self.strip_files[event.session] = event.paths['strip']
+            print('Strip for session {} ready: {}'.format(event.session, event.paths))
+            self.send_when_ready(event.session)
+        elif event.action == 'strip_failed':
+            self.rendering.pop(event.session, None)
+            self.strip_files[event.session] = None
+            self.send_when_ready(event.session)
+
+    def send_when_ready(self, session):
+        """Email a session's strip once its address has been asked for and the strip is done"""
+        if session not in self.emails or session not in self.strip_files:
+            return
+        (email, strip_file) = (self.emails.pop(session), self.strip_files.pop(session))
+        if email is not None and strip_file is None:
+            print('Not emailing session {}, its strip failed'.format(session))
+        elif email is not None:
+            email_thread = threading.Thread(target=BoothView.send_strip, args=[email, strip_file, self.timings])
+            email_thread.start()
 
     @staticmethod
-    def send_strip(email_addr, filepath):
+    def send_strip(email_addr, filepath, timings=None):
         start = time.time()
         msg = MIMEMultipart()
         msg['From'] = FROM_ADDR
@@ -269,35 +420,68 @@ class BoothView(object):
         server.login(FROM_ADDR, 'aI6Y&i&ACTv9R#RFMg3m')
         server.sendmail(FROM_ADDR, email_addr, msg.as_string())
         finish = time.time()
+        if timings is not None:
+            timings.record('email', finish - start)
         print(('Email sending to {4} started {0}, finished {1}, elapsed {2}. Output {3}'.format(start, finish, finish - start, filepath, email_addr)))
 
     def draw_centered_text(self, text, font=None, color=(255, 255, 255), outline=False):
         """Center text in window"""
-        if font == None:
-            font = self.small_font
-        fw, fh = font.size(text)
-        if outline:
-            textobj = font.render(text, True, (0, 0, 0))
-            for xoffset in (-1, 1):
-                for yoffset in (-1, 1):
-                    textpos = textobj.get_rect(centerx=self.background.get_width() / 2 + xoffset,
-                                               centery=self.background.get_height() / 2 + yoffset)
-                    self.screen.blit(textobj, textpos)
-        textobj = font.render(text, True, color)
-        textpos = textobj.get_rect(centerx=self.background.get_width() / 2, centery=self.background.get_height() / 2)
-        self.screen.blit(textobj, textpos)
+        with self.timings.span('text'):
+            if font == None:
+                font = self.small_font
+            self.screen.blit(*self.text_cache.get(text, font, color, outline))
+
+    def draw_hud(self):
+        """Timing breakdown in the top left corner, toggled with F1"""
+        y = 5
+        lines = self.timings.hud_lines()
+        for (session, (done, total)) in sorted(self.rendering.items()):
+            lines.append('strip {}: {}/{} pieces'.format(session, done, total))
+        for line in lines:
+            textobj = self.small_font.render(line, True, (255, 255, 0), (0, 0, 0))
+            self.screen.blit(textobj, (5, y))
+            y += textobj.get_height()
+
+    def dump_timings(self):
+        path = os.path.join(STORE_DIR, 'timings-{}.csv'.format(self.pid))
+        self.timings.dump_csv(path)
+        print('Timings written to {}'.format(path))
+
+    def apply_profile(self, name):
+        profile = self.profiles.get(name)
+        if profile is None:
+            return
+        try:
+            with self.preview.camera_lock:
+                changed = self.camera.apply_profile(profile)
+        except piggyphoto.libgphoto2error as e:
+            print('Applying camera profile {} failed: {}'.format(name, e))
+            return
+        if changed:
+            print('Camera profile {} changed {}'.format(name, ', '.join(changed)))
 
     def switch_state(self, target):
         if target == BoothState.shooting:
             # Transition IN to shooting
+            self.apply_profile('shoot')
             self.countdown = READY_WAIT
-            self.fps = 60  # This is a placeholder for infinity in this case...
+            self.governor.target_fps = SHOOT_FPS
             self.shoot_phase = ShootPhase.get_ready
             self.shots_left = SHOT_COUNT
-            self.images = []
+            self.images = [None] * SHOT_COUNT
+            self.shot_frames = [None] * SHOT_COUNT
+            self.submitted = {}
+            self.shots_done = set()
+            self.capture.drain()
+            self.strip = self.strips.session(self.session_counter, os.path.join(STORE_DIR, '{0}{1}-{2:04d}-{3}.jpg'.format(
+                SAVE_PREFIX, self.pid, self.session_counter, STRIP_SUFFIX)), self.strip_plan)
             self.phase_start = time.time()
+            self.session_start = self.phase_start
+        elif target == BoothState.thanks:
+            self.timings.record('session', time.time() - self.session_start)
         elif target == BoothState.waiting:
-            self.fps = self.base_fps
+            self.apply_profile('attract')
+            self.governor.target_fps = self.base_fps
         if self.state == BoothState.thanks:
             # When transitioning OUT of thanks
             self.shot_counter = 0
@@ -319,23 +503,29 @@ def serial_listener():
         elif command == b'r':
             print('Ready signal received from Arduino')
 
-def get_resize_transform(current, desired):
-    """Takes two dimension tuples in (w, h) form, and returns the dimension to scale to, and the number of pixels in each dimension to crop"""
-    if len(current) != 2 or len(desired) != 2:
-        raise ValueError('Current and desired must both contain exactly two dimensions')
-    w_ratio = float(desired[0])/current[0]
-    h_ratio = float(desired[1])/current[1]
-    scale_factor = max(w_ratio, h_ratio)
-    dims = (int(current[0] * scale_factor), int(current[1] * scale_factor))
-    w_crop = dims[0] - desired[0]
-    h_crop = dims[1] - desired[1]
-    crop = (int(w_crop), int(h_crop))
-    return (dims, crop)
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='A fun photobooth')
     parser.add_argument('--serial', help='the serial port to listen for a button', default='/dev/ttyACM0', nargs='?', type=str)
     #parser.add_argument('camera', help='the gphoto device to use', default="/dev/ttyACM0")
+    parser.add_argument('--fake-camera', help='serve previews from a directory of JPEGs instead of a real camera', metavar='DIR')
+    parser.add_argument('--fake-captures', help='directory of full size JPEGs for the fake camera to "shoot"', metavar='DIR')
+    parser.add_argument('--fake-latency', help='seconds the fake camera takes per preview frame', default=0.0, type=float)
+    parser.add_argument('--fake-failure-rate', help='probability of a fake camera call failing', default=0.0, type=float)
+    parser.add_argument('--record-preview', help='append every preview frame to this recording', metavar='FILE')
+    parser.add_argument('--replay-preview', help='feed the preview from a recording instead of a camera', metavar='FILE')
+    parser.add_argument('--replay-fast', help='replay as fast as possible rather than in real time', action='store_true')
+    parser.add_argument('--capture-mode', help='ram: small JPEGs straight from camera memory, card: as the camera is set',
+                        choices=('ram', 'card'), default='ram')
+    parser.add_argument('--archive', help='also keep a full resolution RAW of every shot on the camera card',
+                        action='store_true')
+    parser.add_argument('--card-keep', help='verified shots to leave on the camera card before deleting the oldest',
+                        type=int, default=50)
+    parser.add_argument('--no-card-cleanup', help='never delete anything from the camera card', action='store_true')
+    parser.add_argument('--layout', help='strip template and photo layout', choices=sorted(LAYOUTS), default='portrait')
+    parser.add_argument('--profiles', help='JSON file of camera profiles, "attract" and "shoot" are applied automatically',
+                        metavar='FILE')
+    parser.add_argument('--save-profile', help='save the current camera settings into --profiles under this name, then exit',
+                        metavar='NAME')
 
     args = parser.parse_args()
     SERIAL = args.serial
@@ -347,7 +537,32 @@ if __name__ == '__main__':
     listener = threading.Thread(target=serial_listener)
     listener.daemon = True
     listener.start()
-    BoothView(width=1050, height=1680, fullscreen=False).run()
+    camera = None
+    if args.fake_camera or args.replay_preview:
+        from piggyphoto.fake import fakeCamera
+        source = args.fake_camera
+        if args.replay_preview:
+            from piggyphoto.recorder import recordedSource
+            source = recordedSource(args.replay_preview, realtime=not args.replay_fast)
+        camera = fakeCamera(source, capture_dir=args.fake_captures, preview_latency=args.fake_latency,
+                            failure_rate=args.fake_failure_rate)
+    if args.record_preview:
+        from piggyphoto.recorder import previewRecorder
+        camera = previewRecorder(camera if camera is not None else piggyphoto.camera(), args.record_preview)
+    profiles = {}
+    if args.profiles and os.path.exists(args.profiles):
+        profiles = piggyphoto.load_profiles(args.profiles)
+    if args.save_profile:
+        if not args.profiles:
+            parser.error('--save-profile needs --profiles')
+        camera = camera if camera is not None else piggyphoto.camera()
+        profiles[args.save_profile] = camera.save_profile(args.save_profile)
+        piggyphoto.save_profiles(args.profiles, profiles)
+        print('Saved {}'.format(profiles[args.save_profile]))
+        sys.exit()
+    BoothView(width=1050, height=1680, fullscreen=False, camera=camera, profiles=profiles,
+              capture_mode=args.capture_mode, archive=args.archive,
+              card_keep=None if args.no_card_cleanup else args.card_keep, layout=args.layout).run()
 
 def quit_pressed():
     for event in pygame.event.get():
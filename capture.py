@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+import queue
+
+import pygame
+
+import piggyphoto
+
+# Camera side JPEG sizes in order of preference: big enough for a strip slot, no bigger
+SMALL_JPEG_CHOICES = (('small', 'fine'), ('small', 'normal'), ('s1', 'fine'), ('s1',),
+                      ('medium', 'fine'), ('medium', 'normal'), ('m1',), ('m',))
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+
+def pick_choice(choices, patterns, exclude=(), require=()):
+    """First choice containing every word of the earliest matching pattern"""
+    for pattern in patterns:
+        for choice in choices:
+            words = choice.lower().replace('+', ' ').split()
+            if any(word in words for word in exclude) or not all(word in words for word in require):
+                continue
+            if all(word in words for word in pattern):
+                return choice
+    return None
+
+
+def capture_mode_profile(camera, mode='ram', archive=False):
+    """Work out the camera profile for a capture mode.
+
+    'ram' shoots into the camera's internal RAM at a small JPEG size, so
+    only what the strip needs comes over USB and nothing is left on the card.
+    With archive, the camera instead shoots RAW + small JPEG to the card: the
+    JPEG is downloaded, the RAW stays behind as the full resolution copy.
+    'card' leaves the camera as it is.
+
+    Returns (profile, files_per_shot). The profile is None if there is
+    nothing to change. files_per_shot follows the image format the camera
+    will be shooting, so a RAW + JPEG camera left as it is still gets both
+    of its files matched to the shot.
+    """
+    cfg = camera.config_snapshot()
+    try:
+        settings = {}
+        target = cfg.names.get('capturetarget')
+        image_format = cfg.names.get('imageformat')
+        changing = mode != 'card' or archive
+        if changing and target is not None:
+            wanted = ('memory', 'card') if archive else ('internal', 'ram')
+            choice = pick_choice(target.choices, [wanted])
+            if choice is not None:
+                settings['capturetarget'] = choice
+        if changing and image_format is not None:
+            if archive:
+                choice = pick_choice(image_format.choices, SMALL_JPEG_CHOICES, require=('raw',))
+                if choice is None:
+                    choice = pick_choice(image_format.choices, [('jpeg',)], require=('raw',))
+                    print('No RAW + small JPEG format, the full size JPEG will be downloaded')
+            else:
+                choice = pick_choice(image_format.choices, SMALL_JPEG_CHOICES, exclude=('raw',))
+            if choice is not None:
+                settings['imageformat'] = choice
+        files_per_shot = 1
+        if image_format is not None:
+            # 'RAW + Small Fine JPEG' and the like write two files for every shot
+            shooting = settings.get('imageformat', image_format.value) or ''
+            if '+' in shooting:
+                files_per_shot = 2
+        if not settings:
+            if changing:
+                print('Camera has no capture target or image format to set, leaving it as it is')
+            return (None, files_per_shot)
+        return (piggyphoto.cameraProfile('capture-' + mode, settings), files_per_shot)
+    finally:
+        cfg.close()
+
+
+class CardKeeper(object):
+    """Stops downloaded shots piling up on the camera's card.
+
+    Each downloaded file is checked against the size the camera reports for
+    it, and queued once it matches. sweep() then deletes queued files, oldest
+    first, until at most `keep` of them are left on the card. A file that was
+    never verified is never deleted, so a RAW archive copy, or a shot whose
+    download came up short, stays on the card.
+
+    With a path, the verified list is kept in that JSON file, so shots
+    verified by an earlier run (the booth gets restarted in a loop) are
+    still swept.
+    """
+    def __init__(self, camera, keep=50, batch=4, path=None):
+        self.camera = camera
+        self.keep = keep
+        self.batch = batch
+        self.path = path
+        self.unverified = 0
+        self._verified = deque()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._verified.extend(tuple(entry) for entry in json.load(f))
+            except ValueError as e:
+                print('Ignoring unreadable card list {}: {}'.format(path, e))
+
+    def _save(self):
+        if self.path is None:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(list(self._verified), f)
+        os.rename(self.path + '.tmp', self.path)
+
+    @property
+    def pending(self):
+        """How many verified files are due for deletion"""
+        return max(0, len(self._verified) - self.keep)
+
+    def verify(self, folder, name, destpath):
+        """Returns True if destpath is a complete copy of folder/name. Needs the camera lock"""
+        try:
+            expected = self.camera.file_size(folder, name)
+        except piggyphoto.libgphoto2error as e:
+            print('Could not get the size of {}/{}: {}'.format(folder, name, e))
+            expected = None
+        try:
+            actual = os.path.getsize(destpath)
+        except OSError:
+            actual = None
+        if expected is None or actual != expected:
+            print('Leaving {}/{} on the card, {} is {} bytes, expected {}'.format(
+                folder, name, destpath, actual, expected))
+            self.unverified += 1
+            return False
+        self._verified.append((folder, name))
+        self._save()
+        return True
+
+    def sweep(self, camera_lock):
+        """Delete up to `batch` files past the keep limit, taking the camera lock
+        for one file at a time so the preview isn't held up. Returns how many went"""
+        deleted = 0
+        while deleted < self.batch and self.pending:
+            (folder, name) = self._verified.popleft()
+            with camera_lock:
+                try:
+                    self.camera.delete_file(folder, name)
+                except piggyphoto.libgphoto2error as e:
+                    print('Could not delete {}/{} from the card: {}'.format(folder, name, e))
+                    continue
+            deleted += 1
+        self._save()
+        return deleted
+
+
+class CaptureWorker(threading.Thread):
+    """Takes photos and downloads them off the render loop.
+
+    Shots go out with trigger_capture() and each file is downloaded when the
+    camera's FILE_ADDED event for it arrives, so a new shot can be fired
+    while the last one is still downloading. Cameras that can't trigger fall
+    back to a blocking capture_image() per shot. All camera access holds
+    camera_lock.
+
+    With a CardKeeper, every download is verified against the camera's copy,
+    and whenever the worker has been idle for sweep_delay seconds the keeper
+    clears verified files off the card.
+
+    When a shot is done, a USEREVENT is posted with action
+    'capture_complete' (or 'capture_failed', with the error) carrying the
+    shot's index and filename. Every shot gets exactly one of the two, so a
+    shot whose files all arrived without a JPEG among them is a failure.
+    """
+    poll_interval = 50  # ms spent waiting on camera events before letting the preview back in
+    shot_timeout = 15  # seconds to wait for a triggered shot's file before giving up
+    sweep_delay = 5  # seconds without a shot before deleting anything from the card
+
+    def __init__(self, camera, camera_lock, timings=None, use_events=True, files_per_shot=1, keeper=None):
+        super(CaptureWorker, self).__init__(name='CaptureWorker')
+        self.daemon = True
+        self.camera = camera
+        self.camera_lock = camera_lock
+        self.timings = timings
+        self.keeper = keeper
+        self.files_per_shot = files_per_shot
+        self.pipeline = piggyphoto.capturePipeline(camera, files_per_shot) if use_events else None
+        self._shots = {}  # token: [files still to come, event posted] for each triggered shot
+        self._jobs = queue.Queue()
+
+    def submit(self, index, filename):
+        self._jobs.put((index, filename))
+
+    def drain(self):
+        """Clear out anything left in the camera's event queue before a new session"""
+        self._jobs.put('drain')
+
+    def stop(self):
+        self._jobs.put(None)
+
+    def _record(self, stage, start):
+        if self.timings is not None:
+            self.timings.record(stage, time.time() - start)
+
+    def _complete(self, index, filename):
+        pygame.event.post(pygame.event.Event(pygame.USEREVENT, action='capture_complete', index=index,
+                                             filename=filename))
+
+    def _failed(self, index, filename, error):
+        print('Capture of {} failed: {}'.format(filename, error))
+        pygame.event.post(pygame.event.Event(pygame.USEREVENT, action='capture_failed', index=index,
+                                             filename=filename, error=str(error)))
+
+    def shoot(self, index, filename):
+        """Blocking capture and download, for cameras without trigger_capture"""
+        with self.camera_lock:
+            start = time.time()
+            (folder, name) = self.camera.capture_image()
+            self._record('capture_image', start)
+            start = time.time()
+            self.camera.download_file(folder, name, filename)
+            self._record('download', start)
+            if self.keeper is not None:
+                self.keeper.verify(folder, name, filename)
+        self._complete(index, filename)
+
+    def destination(self, filename):
+        """Only the JPEG of a shot is downloaded, anything else (RAW) stays on the card"""
+        def destpath(folder, name):
+            return filename if name.lower().endswith(JPEG_EXTENSIONS) else None
+        return destpath
+
+    def trigger(self, index, filename):
+        try:
+            with self.camera_lock:
+                start = time.time()
+                self.pipeline.trigger(self.destination(filename), token=(index, filename))
+                self._shots[(index, filename)] = [self.files_per_shot, False]
+                self._record('capture_image', start)
+        except piggyphoto.libgphoto2error as e:
+            if e.result != piggyphoto.GP_ERROR_NOT_SUPPORTED:
+                raise
+            print('Camera cannot trigger captures, falling back to capture_image')
+            self.pipeline = None
+            self.shoot(index, filename)
+
+    def poll(self):
+        with self.camera_lock:
+            start = time.time()
+            (done, failed) = self.pipeline.poll(self.poll_interval)
+            if done:
+                self._record('download', start)
+            if self.keeper is not None:
+                for (token, folder, name, destpath) in done:
+                    if destpath is not None:
+                        self.keeper.verify(folder, name, destpath)
+        for (token, folder, name, destpath) in done:
+            if destpath is not None:
+                self._shot_over(token, self._complete)
+            self._file_arrived(token)
+        for (token, folder, name, error) in failed:
+            self._shot_over(token, self._failed, 'downloading {}/{}: {}'.format(folder, name, error))
+            self._file_arrived(token)
+        for token in self.pipeline.expire(self.shot_timeout):
+            self._shot_over(token, self._failed, 'no file arrived from the camera')
+            self._shots.pop(token, None)
+
+    def _shot_over(self, token, post, *args):
+        """Post the shot's one event, unless it already has one"""
+        shot = self._shots.get(token)
+        if shot is not None and not shot[1]:
+            shot[1] = True
+            post(token[0], token[1], *args)
+
+    def _file_arrived(self, token):
+        shot = self._shots.get(token)
+        if shot is None:
+            return
+        shot[0] -= 1
+        if shot[0] <= 0:
+            self._shot_over(token, self._failed, 'no JPEG from the camera')
+            del self._shots[token]
+
+    def sweep(self):
+        start = time.time()
+        if self.keeper.sweep(self.camera_lock):
+            self._record('card_sweep', start)
+
+    def run(self):
+        while True:
+            waiting = self.pipeline is not None and self.pipeline.pending
+            sweeping = not waiting and self.keeper is not None and self.keeper.pending
+            try:
+                job = self._jobs.get(block=not waiting, timeout=self.sweep_delay if sweeping else None)
+            except queue.Empty:
+                job = False
+                if sweeping:
+                    self.sweep()
+            if job is None:
+                break
+            if job == 'drain':
+                if self.pipeline is not None:
+                    with self.camera_lock:
+                        for (folder, name) in self.pipeline.drain():
+                            print('Leaving {}/{} on the camera, no shot was waiting for it'.format(folder, name))
+            elif job:
+                (index, filename) = job
+                try:
+                    if self.pipeline is not None:
+                        self.trigger(index, filename)
+                    else:
+                        self.shoot(index, filename)
+                except Exception as e:
+                    self._failed(index, filename, e)
+            if self.pipeline is not None and self.pipeline.pending:
+                try:
+                    self.poll()
+                except Exception as e:
+                    print('Polling camera events failed: {}'.format(e))
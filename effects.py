@@ -0,0 +1,163 @@
+import time
+
+import numpy
+import pygame
+
+
+class Effect(object):
+    """An in-place effect on a preview surface.
+
+    Every call is timed, and an exponential moving average of the cost in
+    seconds is kept in self.cost so a pipeline can decide what it can afford.
+    The first call is left out, it pays for one-off setup like building a
+    mask and says nothing about what the effect costs from then on.
+    """
+    name = None
+    smoothing = 0.2
+
+    def __init__(self):
+        self.cost = None
+        self.warmed_up = False
+
+    def __call__(self, surface):
+        start = time.time()
+        self.apply(surface)
+        elapsed = time.time() - start
+        if not self.warmed_up:
+            self.warmed_up = True
+        elif self.cost is None:
+            self.cost = elapsed
+        else:
+            self.cost += self.smoothing * (elapsed - self.cost)
+
+    def apply(self, surface):
+        raise NotImplementedError
+
+
+class Dim(Effect):
+    """Darken by bit shifting every channel, no floats and no copies"""
+    name = 'dim'
+
+    def __init__(self, shift=1):
+        super(Dim, self).__init__()
+        self.shift = shift
+
+    def apply(self, surface):
+        pixels = pygame.surfarray.pixels3d(surface)
+        pixels >>= self.shift
+        del pixels
+
+
+class DownscaleBlur(Effect):
+    """Cheap blur: shrink the frame, then smooth it back up to size"""
+    name = 'blur'
+
+    def __init__(self, factor=8):
+        super(DownscaleBlur, self).__init__()
+        self.factor = factor
+
+    def apply(self, surface):
+        (width, height) = surface.get_size()
+        small = pygame.transform.smoothscale(surface, (max(1, width // self.factor), max(1, height // self.factor)))
+        pygame.transform.smoothscale(small, (width, height), surface)
+
+
+def _box_blur_axis(pixels, radius, axis):
+    """Running mean along one axis using a cumulative sum, edges are clamped"""
+    pixels = numpy.swapaxes(pixels, 0, axis)
+    size = 2 * radius + 1
+    padded = numpy.concatenate((pixels[:1].repeat(radius + 1, 0), pixels, pixels[-1:].repeat(radius, 0)))
+    totals = numpy.cumsum(padded, axis=0, dtype=numpy.uint32)
+    blurred = (totals[size:] - totals[:-size]) // size
+    return numpy.swapaxes(blurred, 0, axis)
+
+
+class BoxBlur(Effect):
+    """Separable box blur, one pass across and one pass down"""
+    name = 'box_blur'
+
+    def __init__(self, radius=4):
+        super(BoxBlur, self).__init__()
+        self.radius = radius
+
+    def apply(self, surface):
+        pixels = pygame.surfarray.pixels3d(surface)
+        blurred = _box_blur_axis(pixels, self.radius, 0)
+        pixels[...] = _box_blur_axis(blurred, self.radius, 1)
+        del pixels
+
+
+class Vignette(Effect):
+    """Fade the edges to black. The mask is worked out once per surface size"""
+    name = 'vignette'
+
+    def __init__(self, strength=0.7):
+        super(Vignette, self).__init__()
+        self.strength = strength
+        self._masks = {}
+
+    def mask(self, size):
+        mask = self._masks.get(size)
+        if mask is None:
+            (width, height) = size
+            x = numpy.linspace(-1, 1, width)[:, numpy.newaxis]
+            y = numpy.linspace(-1, 1, height)[numpy.newaxis, :]
+            distance = (x * x + y * y) / 2.0
+            # 8 bit fixed point, so applying it is a multiply and a shift
+            mask = (256 * (1 - self.strength * distance)).clip(0, 256).astype(numpy.uint16)
+            mask = self._masks[size] = mask[:, :, numpy.newaxis]
+        return mask
+
+    def apply(self, surface):
+        pixels = pygame.surfarray.pixels3d(surface)
+        pixels[...] = (pixels * self.mask(surface.get_size())) >> 8
+        del pixels
+
+
+EFFECTS = dict((effect.name, effect) for effect in (Dim, DownscaleBlur, BoxBlur, Vignette))
+
+
+class EffectPipeline(object):
+    """Runs a chain of effects over a surface within a time budget.
+
+    Effects are applied in order. Once an effect has been measured, it is
+    switched off for any frame where it would push the total past the
+    budget. To stop it flickering on and off around the limit, it then stays
+    off for at least `min_off` frames, and only comes back once there is room
+    for `resume_margin` times its cost. Every `probe_interval` frames off, it
+    is run on a copy of the frame that is never shown, so its cost is
+    measured again and it can come back when things get cheaper.
+    """
+    probe_interval = 100
+    min_off = 30
+    resume_margin = 1.5
+
+    def __init__(self, effects, budget=None):
+        self.effects = [EFFECTS[effect]() if isinstance(effect, str) else effect for effect in effects]
+        self.budget = budget
+        self._off = dict((effect, 0) for effect in self.effects)  # frames each effect has been off, 0 while on
+
+    def __call__(self, surface, budget=None):
+        if budget is None:
+            budget = self.budget
+        applied = []
+        spent = 0.0
+        for effect in self.effects:
+            off = self._off[effect]
+            if budget is not None and effect.cost is not None:
+                needed = effect.cost * (self.resume_margin if off else 1.0)
+                if 0 < off < self.min_off or spent + needed > budget:
+                    self._off[effect] = off + 1
+                    if self._off[effect] % self.probe_interval == 0:
+                        effect(surface.copy())
+                    continue
+            self._off[effect] = 0
+            effect(surface)
+            spent += effect.cost or 0.0
+            applied.append(effect.name)
+        return applied
+
+    @property
+    def cost(self):
+        """Measured cost of running every effect in the chain"""
+        return sum(effect.cost or 0.0 for effect in self.effects)
@@ -10,6 +10,12 @@
 # Retries are performed on: camera.capture_preview, camera.capture_image and camera.init()
 retries = 1
 
+# Settings a cameraProfile captures unless told otherwise
+profile_settings = ('iso', 'shutterspeed', 'aperture', 'imageformat', 'capturetarget')
+
+# Number of cameraFile handles each camera keeps around for reuse by camera.preview()
+preview_pool_size = 2
+
 # This is run if gp_camera_init returns -60 (Could not lock the device) and retries >= 1.
 unmount_cmd = 'gvfs-mount -s gphoto2'
 
@@ -24,11 +30,54 @@ libgphoto2dll = 'libgphoto2.so'
 
 import re
 import ctypes
-gp = ctypes.CDLL(libgphoto2dll)
-context = gp.gp_context_new()
+import threading
+
+class _library(object):
+    """libgphoto2, loaded the first time anything is called on it.
+
+    Entry points are bound once, with the argtypes and restype from
+    _prototypes, and cached as attributes so later calls skip the lookup.
+    """
+    def __init__(self):
+        self._dll = None
+        self._context = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        with self._lock:
+            if self._dll is None:
+                dll = ctypes.CDLL(libgphoto2dll)
+                context_new = dll.gp_context_new
+                context_new.restype = ctypes.c_void_p
+                context_new.argtypes = []
+                self._context = ctypes.c_void_p(context_new())
+                self._dll = dll
+        return self._dll
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        dll = self._dll or self._load()
+        with self._lock:
+            func = getattr(dll, name)
+            if name in _prototypes:
+                func.restype, func.argtypes = _prototypes[name]
+            setattr(self, name, func)
+        return func
+
+    @property
+    def loaded(self):
+        return self._dll is not None
+
+    @property
+    def context(self):
+        if self._context is None:
+            self._load()
+        return self._context
+
+gp = _library()
 
 def library_version(verbose = True):
-    gp.gp_library_version.restype = ctypes.POINTER(ctypes.c_char_p)
     if not verbose:
         arrText = gp.gp_library_version(GP_VERSION_SHORT)
     else:
@@ -38,14 +87,21 @@ def library_version(verbose = True):
     for s in arrText:
         if s is None:
             break
-        v += '%s\n' % s
+        v += '%s\n' % s.decode()
     return v
 
-import os, string, time
-from .ptp import *
+import os, string, time, json
+from collections import deque
+from contextlib import contextmanager
 
 PTR = ctypes.pointer
 
+def _b(s):
+    """Strings headed for a const char * argument"""
+    if s is None or isinstance(s, bytes):
+        return s
+    return str(s).encode('utf-8')
+
 # gphoto structures
 """ From 'gphoto2-camera.h'
 typedef struct {
@@ -60,6 +116,38 @@ class CameraFilePath(ctypes.Structure):
 class CameraText(ctypes.Structure):
     _fields_ = [('text', (ctypes.c_char * (32 * 1024)))]
 
+""" From 'gphoto2-filesys.h' (2.5), the preview/file/audio parts of CameraFileInfo
+all start with the same fields, the file part goes on with its own.
+"""
+class CameraFileInfoPreview(ctypes.Structure):
+    _fields_ = [('fields', ctypes.c_int),
+                ('status', ctypes.c_int),
+                ('size', ctypes.c_uint64),
+                ('type', (ctypes.c_char * 64)),
+                ('width', ctypes.c_uint32),
+                ('height', ctypes.c_uint32)]
+
+class CameraFileInfoFile(ctypes.Structure):
+    _fields_ = [('fields', ctypes.c_int),
+                ('status', ctypes.c_int),
+                ('size', ctypes.c_uint64),
+                ('type', (ctypes.c_char * 64)),
+                ('width', ctypes.c_uint32),
+                ('height', ctypes.c_uint32),
+                ('permissions', ctypes.c_int),
+                ('mtime', ctypes.c_long)]
+
+class CameraFileInfoAudio(ctypes.Structure):
+    _fields_ = [('fields', ctypes.c_int),
+                ('status', ctypes.c_int),
+                ('size', ctypes.c_uint64),
+                ('type', (ctypes.c_char * 64))]
+
+class CameraFileInfo(ctypes.Structure):
+    _fields_ = [('preview', CameraFileInfoPreview),
+                ('file', CameraFileInfoFile),
+                ('audio', CameraFileInfoAudio)]
+
 #cdef extern from "gphoto2/gphoto2-port-version.h":
 #  ctypedef enum GPVersionVerbosity:
 GP_VERSION_SHORT = 0
@@ -128,25 +216,43 @@ class CameraAbilities(ctypes.Structure):
 
 # the GPPortInfo data structure is a pointer in SVN
 # in stable versions, it is a struct
-if library_version().split('\n')[0] == '2.4.99':
-    class PortInfo(ctypes.c_void_p):
-        pass
-else:
-    class PortInfo(ctypes.Structure):
-        _fields_ = [
-                ('type', ctypes.c_int), # enum is 32 bits on 32 and 64 bit Linux
-                ('name', (ctypes.c_char * 64)),
-                ('path', (ctypes.c_char * 64)),
-                ('library_filename', (ctypes.c_char * 1024))
-                ]
+# Which one we need depends on the library, so it's only decided once it's loaded
+_port_info = []
+def _port_info_class():
+    if not _port_info:
+        if library_version().split('\n')[0] == '2.4.99':
+            class PortInfo(ctypes.c_void_p):
+                pass
+        else:
+            class PortInfo(ctypes.Structure):
+                _fields_ = [
+                        ('type', ctypes.c_int), # enum is 32 bits on 32 and 64 bit Linux
+                        ('name', (ctypes.c_char * 64)),
+                        ('path', (ctypes.c_char * 64)),
+                        ('library_filename', (ctypes.c_char * 1024))
+                        ]
+        _port_info.append(PortInfo)
+    return _port_info[0]
 
 # gphoto constants
 # Defined in 'gphoto2-port-result.h'
 GP_OK = 0
+GP_ERROR = -1
+GP_ERROR_NOT_SUPPORTED = -6
 # CameraCaptureType enum in 'gphoto2-camera.h'
 GP_CAPTURE_IMAGE = 0
 # CameraFileType enum in 'gphoto2-file.h'
 GP_FILE_TYPE_NORMAL = 1
+# CameraFileInfoFields bits in 'gphoto2-filesys.h'
+GP_FILE_INFO_TYPE = 1 << 0
+GP_FILE_INFO_SIZE = 1 << 2
+# CameraEventType enum in 'gphoto2-camera.h'
+GP_EVENT_UNKNOWN = 0
+GP_EVENT_TIMEOUT = 1
+GP_EVENT_FILE_ADDED = 2
+GP_EVENT_FOLDER_ADDED = 3
+GP_EVENT_CAPTURE_COMPLETE = 4
+event_types = ['Unknown', 'Timeout', 'FileAdded', 'FolderAdded', 'CaptureComplete']
 
 
 
@@ -184,6 +290,70 @@ class CameraWidget(ctypes.Structure):
                 ('callback', (ctypes.c_void_p))]
 
 
+_c = ctypes
+_ptr = ctypes.POINTER
+# (restype, argtypes) for the entry points we call, declared once up front
+_prototypes = {
+    'gp_library_version': (_ptr(_c.c_char_p), [_c.c_int]),
+    'gp_result_as_string': (_c.c_char_p, [_c.c_int]),
+    'gp_camera_new': (_c.c_int, [_ptr(_c.c_void_p)]),
+    'gp_camera_init': (_c.c_int, [_c.c_void_p, _c.c_void_p]),
+    'gp_camera_exit': (_c.c_int, [_c.c_void_p, _c.c_void_p]),
+    'gp_camera_free': (_c.c_int, [_c.c_void_p]),
+    'gp_camera_ref': (_c.c_int, [_c.c_void_p]),
+    'gp_camera_unref': (_c.c_int, [_c.c_void_p]),
+    'gp_camera_capture': (_c.c_int, [_c.c_void_p, _c.c_int, _ptr(CameraFilePath), _c.c_void_p]),
+    'gp_camera_capture_preview': (_c.c_int, [_c.c_void_p, _c.c_void_p, _c.c_void_p]),
+    'gp_camera_trigger_capture': (_c.c_int, [_c.c_void_p, _c.c_void_p]),
+    'gp_camera_wait_for_event': (_c.c_int, [_c.c_void_p, _c.c_int, _ptr(_c.c_int), _ptr(_c.c_void_p), _c.c_void_p]),
+    'gp_camera_file_get': (_c.c_int, [_c.c_void_p, _c.c_char_p, _c.c_char_p, _c.c_int, _c.c_void_p, _c.c_void_p]),
+    'gp_camera_file_get_info': (_c.c_int, [_c.c_void_p, _c.c_char_p, _c.c_char_p, _ptr(CameraFileInfo), _c.c_void_p]),
+    'gp_camera_file_delete': (_c.c_int, [_c.c_void_p, _c.c_char_p, _c.c_char_p, _c.c_void_p]),
+    'gp_camera_get_config': (_c.c_int, [_c.c_void_p, _ptr(_c.c_void_p), _c.c_void_p]),
+    'gp_camera_set_config': (_c.c_int, [_c.c_void_p, _c.c_void_p, _c.c_void_p]),
+    'gp_camera_get_single_config': (_c.c_int, [_c.c_void_p, _c.c_char_p, _ptr(_c.c_void_p), _c.c_void_p]),
+    'gp_camera_set_single_config': (_c.c_int, [_c.c_void_p, _c.c_char_p, _c.c_void_p, _c.c_void_p]),
+    'gp_camera_folder_list_files': (_c.c_int, [_c.c_void_p, _c.c_char_p, _c.c_void_p, _c.c_void_p]),
+    'gp_camera_folder_list_folders': (_c.c_int, [_c.c_void_p, _c.c_char_p, _c.c_void_p, _c.c_void_p]),
+    'gp_file_new': (_c.c_int, [_ptr(_c.c_void_p)]),
+    'gp_file_new_from_fd': (_c.c_int, [_ptr(_c.c_void_p), _c.c_int]),
+    'gp_file_new_from_handler': (_c.c_int, [_ptr(_c.c_void_p), _c.c_void_p, _c.c_void_p]),
+    'gp_file_free': (_c.c_int, [_c.c_void_p]),
+    'gp_file_ref': (_c.c_int, [_c.c_void_p]),
+    'gp_file_unref': (_c.c_int, [_c.c_void_p]),
+    'gp_file_clean': (_c.c_int, [_c.c_void_p]),
+    'gp_file_save': (_c.c_int, [_c.c_void_p, _c.c_char_p]),
+    'gp_file_get_data_and_size': (_c.c_int, [_c.c_void_p, _ptr(_c.c_void_p), _ptr(_c.c_ulong)]),
+    'gp_file_get_name': (_c.c_int, [_c.c_void_p, _ptr(_c.c_char_p)]),
+    'gp_file_set_name': (_c.c_int, [_c.c_void_p, _c.c_char_p]),
+    'gp_list_new': (_c.c_int, [_ptr(_c.c_void_p)]),
+    'gp_list_free': (_c.c_int, [_c.c_void_p]),
+    'gp_list_count': (_c.c_int, [_c.c_void_p]),
+    'gp_list_reset': (_c.c_int, [_c.c_void_p]),
+    'gp_list_append': (_c.c_int, [_c.c_void_p, _c.c_char_p, _c.c_char_p]),
+    'gp_list_get_name': (_c.c_int, [_c.c_void_p, _c.c_int, _ptr(_c.c_char_p)]),
+    'gp_list_get_value': (_c.c_int, [_c.c_void_p, _c.c_int, _ptr(_c.c_char_p)]),
+    'gp_widget_new': (_c.c_int, [_c.c_int, _c.c_char_p, _ptr(_c.c_void_p)]),
+    'gp_widget_ref': (_c.c_int, [_c.c_void_p]),
+    'gp_widget_unref': (_c.c_int, [_c.c_void_p]),
+    'gp_widget_count_children': (_c.c_int, [_c.c_void_p]),
+    'gp_widget_get_child': (_c.c_int, [_c.c_void_p, _c.c_int, _ptr(_c.c_void_p)]),
+    'gp_widget_get_child_by_name': (_c.c_int, [_c.c_void_p, _c.c_char_p, _ptr(_c.c_void_p)]),
+    'gp_widget_get_name': (_c.c_int, [_c.c_void_p, _ptr(_c.c_char_p)]),
+    'gp_widget_get_label': (_c.c_int, [_c.c_void_p, _ptr(_c.c_char_p)]),
+    'gp_widget_get_info': (_c.c_int, [_c.c_void_p, _ptr(_c.c_char_p)]),
+    'gp_widget_get_type': (_c.c_int, [_c.c_void_p, _ptr(_c.c_int)]),
+    'gp_widget_get_id': (_c.c_int, [_c.c_void_p, _ptr(_c.c_int)]),
+    'gp_widget_get_readonly': (_c.c_int, [_c.c_void_p, _ptr(_c.c_int)]),
+    'gp_widget_get_value': (_c.c_int, [_c.c_void_p, _c.c_void_p]),
+    'gp_widget_set_value': (_c.c_int, [_c.c_void_p, _c.c_void_p]),
+    'gp_widget_set_changed': (_c.c_int, [_c.c_void_p, _c.c_int]),
+    'gp_widget_changed': (_c.c_int, [_c.c_void_p]),
+    'gp_widget_free': (_c.c_int, [_c.c_void_p]),
+    'gp_widget_count_choices': (_c.c_int, [_c.c_void_p]),
+    'gp_widget_get_choice': (_c.c_int, [_c.c_void_p, _c.c_int, _ptr(_c.c_char_p)]),
+}
+
 class libgphoto2error(Exception):
     def __init__(self, result, message):
         self.result = result
@@ -193,22 +363,23 @@ class libgphoto2error(Exception):
 
 def check(result):
     if result < 0:
-        gp.gp_result_as_string.restype = ctypes.c_char_p
-        message = gp.gp_result_as_string(result)
+        message = gp.gp_result_as_string(result).decode()
         raise libgphoto2error(result, message)
     return result
 
 def check_unref(result, camfile):
     if result!=0:
         gp.gp_file_unref(camfile._cf)
-        gp.gp_result_as_string.restype = ctypes.c_char_p
-        message = gp.gp_result_as_string(result)
+        message = gp.gp_result_as_string(result).decode()
         raise libgphoto2error(result, message)
 
 class camera(object):
     def __init__(self, autoInit = True):
         self._cam = ctypes.c_void_p()
         self._leave_locked = False
+        self._preview_pool = []
+        self._preview_pool_lock = threading.Lock()
+        self._single_config = True  # until the driver says otherwise
         check(gp.gp_camera_new(PTR(self._cam)))
         self.initialized = False
         if autoInit:
@@ -219,7 +390,7 @@ class camera(object):
             print("Camera is already initialized.")
         ans = 0
         for i in range(1 + retries):
-            ans = gp.gp_camera_init(self._cam, context)
+            ans = gp.gp_camera_init(self._cam, gp.context)
             if ans == 0:
                 break
             elif ans == -60:
@@ -236,8 +407,10 @@ class camera(object):
         self.init()
 
     def __del__(self):
-        if not self._leave_locked:
-            check(gp.gp_camera_exit(self._cam))
+        for cfile in self._preview_pool:
+            cfile.free()
+        if not self._leave_locked and self._cam:
+            check(gp.gp_camera_exit(self._cam, gp.context))
             check(gp.gp_camera_free(self._cam))
 
     def leave_locked(self):
@@ -250,23 +423,23 @@ class camera(object):
         check(gp.gp_camera_unref(self._cam))
 
     def exit(self):
-        check(gp.gp_camera_exit(self._cam, context))
+        check(gp.gp_camera_exit(self._cam, gp.context))
 
     def _get_summary(self):
         txt = CameraText()
-        check(gp.gp_camera_get_summary(self._cam, PTR(txt), context))
+        check(gp.gp_camera_get_summary(self._cam, PTR(txt), gp.context))
         return txt.text
     summary = property(_get_summary, None)
 
     def _get_manual(self):
         txt = CameraText()
-        check(gp.gp_camera_get_manual(self._cam, PTR(txt), context))
+        check(gp.gp_camera_get_manual(self._cam, PTR(txt), gp.context))
         return txt.text
     manual = property(_get_manual, None)
 
     def _get_about(self):
         txt = CameraText()
-        check(gp.gp_camera_get_about(self._cam, PTR(txt), context))
+        check(gp.gp_camera_get_about(self._cam, PTR(txt), gp.context))
         return txt.text
     about = property(_get_about, None)
 
@@ -279,12 +452,12 @@ class camera(object):
     abilities = property(_get_abilities, _set_abilities)
 
     def _get_config(self):
-        window = cameraWidget(GP_WIDGET_WINDOW)
-        check(gp.gp_camera_get_config(self._cam, PTR(window._w), context))
+        window = cameraWidget()
+        check(gp.gp_camera_get_config(self._cam, PTR(window._w), gp.context))
         window.populate_children()
         return window
     def _set_config(self, window):
-        check(gp.gp_camera_set_config(self._cam, window._w, context))
+        check(gp.gp_camera_set_config(self._cam, window._w, gp.context))
     config = property(_get_config, _set_config)
 
     def _get_port_info(self):
@@ -298,7 +471,7 @@ class camera(object):
 
         ans = 0
         for i in range(1 + retries):
-            ans = gp.gp_camera_capture(self._cam, GP_CAPTURE_IMAGE, PTR(path), context)
+            ans = gp.gp_camera_capture(self._cam, GP_CAPTURE_IMAGE, PTR(path), gp.context)
             if ans == 0: break
             else: print("capture_image(%s) retry #%d..." % (destpath, i))
         check(ans)
@@ -308,70 +481,252 @@ class camera(object):
         else:
             return (path.folder, path.name)
 
-    def capture_preview(self, destpath = None):
-        path = CameraFilePath()
-        cfile = cameraFile()
-
+    def _capture_preview_into(self, cfile, destpath = None):
         ans = 0
         for i in range(1 + retries):
-            ans = gp.gp_camera_capture_preview(self._cam, cfile._cf, context)
+            ans = gp.gp_camera_capture_preview(self._cam, cfile._cf, gp.context)
             if ans == 0: break
             else: print("capture_preview(%s) retry #%d..." % (destpath, i))
         check(ans)
 
+    def capture_preview(self, destpath = None):
+        cfile = cameraFile()
+        try:
+            self._capture_preview_into(cfile, destpath)
+        except libgphoto2error:
+            cfile.free()
+            raise
+
         if destpath:
             cfile.save(destpath)
+            cfile.free()
         else:
             return cfile
 
+    @contextmanager
+    def preview(self):
+        """Capture a preview frame into a pooled cameraFile.
+
+            with cam.preview() as cfile:
+                data = cfile.data
+
+        The file is cleaned and handed back to the pool when the block exits,
+        so it must not be used afterwards.
+        """
+        with self._preview_pool_lock:
+            cfile = self._preview_pool.pop() if self._preview_pool else None
+        if cfile is None:
+            cfile = cameraFile()
+        try:
+            self._capture_preview_into(cfile)
+            yield cfile
+        finally:
+            try:
+                cfile.clean()
+            except libgphoto2error:
+                cfile.free()
+            else:
+                with self._preview_pool_lock:
+                    if len(self._preview_pool) < preview_pool_size:
+                        self._preview_pool.append(cfile)
+                        cfile = None
+                if cfile is not None:
+                    cfile.free()
+
     def download_file(self, srcfolder, srcfilename, destpath):
-        cfile = cameraFile(self._cam, srcfolder, srcfilename)
-        cfile.save(destpath)
-        gp.gp_file_unref(cfile._cf)
+        """Stream a file off the camera straight into destpath as it arrives"""
+        fd = os.open(destpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            cfile = cameraFile(fd = fd)
+        except:
+            os.close(fd)
+            raise
+        # The cameraFile owns fd now, and closes it when it's freed
+        cfile.get_from(self._cam, srcfolder, srcfilename)
+        cfile.unref()
+
+    def download_to(self, srcfolder, srcfilename, fileobj):
+        """Stream a file off the camera into a Python file-like object.
+        Anything with a fileno() is written through a duplicate of its descriptor,
+        anything else just needs a write() method."""
+        try:
+            fd = fileobj.fileno()
+        except (AttributeError, IOError, ValueError):
+            fd = None
+        if fd is not None:
+            fileobj.flush()
+            fd = os.dup(fd)
+            try:
+                cfile = cameraFile(fd = fd)
+            except:
+                os.close(fd)
+                raise
+        else:
+            cfile = cameraFile(writer = fileobj.write)
+        cfile.get_from(self._cam, srcfolder, srcfilename)
+        cfile.unref()
+
+    def file_info(self, folder, name):
+        """The CameraFileInfo the camera keeps for a file, without downloading it"""
+        info = CameraFileInfo()
+        check(gp.gp_camera_file_get_info(self._cam, _b(folder), _b(name), PTR(info), gp.context))
+        return info
+
+    def file_size(self, folder, name):
+        """Size in bytes of a file on the camera, or None if the camera doesn't say"""
+        info = self.file_info(folder, name).file
+        return info.size if info.fields & GP_FILE_INFO_SIZE else None
+
+    def delete_file(self, folder, name):
+        check(gp.gp_camera_file_delete(self._cam, _b(folder), _b(name), gp.context))
 
     def trigger_capture(self):
-        check(gp.gp_camera_trigger_capture(self._cam, context))
+        check(gp.gp_camera_trigger_capture(self._cam, gp.context))
 
     def wait_for_event(self, timeout):
-        raise NotImplementedError
+        """Wait up to timeout milliseconds for the camera to report something.
+        Always returns a cameraEvent, of type GP_EVENT_TIMEOUT if nothing happened."""
+        type = ctypes.c_int()
+        data = ctypes.c_void_p()
+        check(gp.gp_camera_wait_for_event(self._cam, int(timeout), PTR(type), PTR(data), gp.context))
+        event = cameraEvent(type.value)
+        if data.value:
+            if event.type in (GP_EVENT_FILE_ADDED, GP_EVENT_FOLDER_ADDED):
+                path = ctypes.cast(data, ctypes.POINTER(CameraFilePath)).contents
+                event.folder = path.folder.decode()
+                event.name = path.name.decode()
+            elif event.type == GP_EVENT_UNKNOWN:
+                event.data = ctypes.string_at(data).decode('utf-8', 'replace')
+            # The event data is malloc()ed by libgphoto2 and ours to free
+            _libc().free(data)
+        return event
 
     def list_folders(self, path = "/"):
         l = cameraList()
-        check(gp.gp_camera_folder_list_folders(self._cam, str(path), l._l, context));
+        check(gp.gp_camera_folder_list_folders(self._cam, _b(path), l._l, gp.context));
         return l.toList()
 
     def list_files(self, path = "/"):
         l = cameraList()
-        check(gp.gp_camera_folder_list_files(self._cam, str(path), l._l, context));
+        check(gp.gp_camera_folder_list_files(self._cam, _b(path), l._l, gp.context));
         return l.toList()
 
-    def _list_config(self, widget, cfglist, path):
-        children = widget.children
-        if children:
-            for c in children:
-                self._list_config(c, cfglist, path + "." + c.name)
-        else:
-            print(path, "=", widget.value)
-            cfglist.append(path)
+    def config_snapshot(self):
+        """Fetch the config tree once and return it as a cameraConfig"""
+        root = ctypes.c_void_p()
+        check(gp.gp_camera_get_config(self._cam, PTR(root), gp.context))
+        try:
+            return cameraConfig(_read_config_tree(root, ''), root)
+        except:
+            gp.gp_widget_free(root)
+            raise
+
+    def _get_single_config(self, name):
+        """Fetch just one widget, or None if the driver can't do single settings"""
+        if not self._single_config:
+            return None
+        w = ctypes.c_void_p()
+        try:
+            ans = gp.gp_camera_get_single_config(self._cam, _b(name), PTR(w), gp.context)
+        except AttributeError:
+            # libgphoto2 older than 2.5.10
+            ans = GP_ERROR_NOT_SUPPORTED
+        if ans == GP_ERROR_NOT_SUPPORTED:
+            self._single_config = False
+            return None
+        check(ans)
+        return w
+
+    def get_setting(self, name):
+        """Read one setting, by bare name ('iso') or dotted path"""
+        leaf = name.split('.')[-1]
+        w = self._get_single_config(leaf)
+        if w is not None:
+            try:
+                return _read_widget_value(w, _widget_type(w))
+            finally:
+                gp.gp_widget_free(w)
+        cfg = self.config_snapshot()
+        try:
+            return cfg.find(name).value
+        finally:
+            cfg.close()
+
+    def set_setting(self, name, value):
+        """Change one setting, by bare name ('iso') or dotted path"""
+        leaf = name.split('.')[-1]
+        w = self._get_single_config(leaf)
+        if w is not None:
+            try:
+                _write_widget_value(w, _widget_type(w), value)
+                check(gp.gp_camera_set_single_config(self._cam, _b(leaf), w, gp.context))
+            finally:
+                gp.gp_widget_free(w)
+            return
+        cfg = self.config_snapshot()
+        try:
+            node = cfg.find(name)
+            _write_widget_value(node._w, node.type, value)
+            check(gp.gp_camera_set_config(self._cam, cfg._handle, gp.context))
+        finally:
+            cfg.close()
+
+    def save_profile(self, name, settings = None):
+        """Capture the current values of `settings` as a cameraProfile"""
+        cfg = self.config_snapshot()
+        try:
+            return cameraProfile.from_config(name, cfg, settings)
+        finally:
+            cfg.close()
+
+    def apply_profile(self, profile):
+        """Apply a cameraProfile in a single set_config, touching only the
+        settings that differ. Returns the paths that were changed."""
+        cfg = self.config_snapshot()
+        try:
+            changes = profile.diff(cfg)
+            for (node, value) in changes:
+                _write_widget_value(node._w, node.type, value)
+            if changes:
+                check(gp.gp_camera_set_config(self._cam, cfg._handle, gp.context))
+            return [node.path for (node, value) in changes]
+        finally:
+            cfg.close()
 
     def list_config(self):
         cfglist = []
-        cfg = self.config
-        self._list_config(cfg, cfglist, cfg.name)
+        for node in self.config_snapshot():
+            print(node.path, "=", node.value)
+            cfglist.append(node.path)
         return cfglist
 
     def ptp_canon_eos_requestdevicepropvalue(self, prop):
         params = ctypes.c_void_p(self._cam.value + 12)
+        from .ptp import PTP_OC_CANON_EOS_RequestDevicePropValue
         gp.ptp_generic_no_data(params, PTP_OC_CANON_EOS_RequestDevicePropValue, 1, prop)
 
     # TODO: port_speed, init, config
 
 class cameraFile(object):
-    def __init__(self, cam = None, srcfolder = None, srcfilename = None):
+    """A libgphoto2 CameraFile. By default the data is held in memory; given
+    fd, data is written to that descriptor as it arrives (and the descriptor
+    is closed when the file is freed); given writer, each chunk is passed to
+    writer(bytes) as it arrives."""
+    def __init__(self, cam = None, srcfolder = None, srcfilename = None, fd = None, writer = None):
         self._cf = ctypes.c_void_p()
-        check(gp.gp_file_new(PTR(self._cf)))
+        if fd is not None:
+            check(gp.gp_file_new_from_fd(PTR(self._cf), int(fd)))
+        elif writer is not None:
+            self._handler = _file_handler(writer)
+            check(gp.gp_file_new_from_handler(PTR(self._cf), PTR(self._handler), None))
+        else:
+            check(gp.gp_file_new(PTR(self._cf)))
         if cam:
-            check_unref(gp.gp_camera_file_get(cam, srcfolder, srcfilename, GP_FILE_TYPE_NORMAL, self._cf, context), self)
+            self.get_from(cam, srcfolder, srcfilename)
+
+    def get_from(self, cam, srcfolder, srcfilename):
+        """Fill this file from the camera. On failure the file is unref'd."""
+        check_unref(gp.gp_camera_file_get(cam, _b(srcfolder), _b(srcfilename), GP_FILE_TYPE_NORMAL, self._cf, gp.context), self)
 
 
     def open(self, filename):
@@ -379,7 +734,7 @@ class cameraFile(object):
 
     def save(self, filename = None):
         if filename is None: filename = self.name
-        check(gp.gp_file_save(self._cf, filename.encode("ascii")))
+        check(gp.gp_file_save(self._cf, _b(filename)))
 
     def ref(self):
         check(gp.gp_file_ref(self._cf))
@@ -393,18 +748,57 @@ class cameraFile(object):
     def copy(self, source):
         check(gp.gp_file_copy(self._cf, source._cf))
 
-    def __dealoc__(self, filename):
+    def free(self):
         check(gp.gp_file_free(self._cf))
 
+    def __dealoc__(self, filename = None):
+        # Old name for free(), kept for existing callers
+        self.free()
+
+    def _get_data(self):
+        data = ctypes.c_void_p()
+        size = ctypes.c_ulong()
+        check(gp.gp_file_get_data_and_size(self._cf, PTR(data), PTR(size)))
+        return ctypes.string_at(data.value, size.value)
+    data = property(_get_data, None)
+
     def _get_name(self):
         name = ctypes.c_char_p()
         check(gp.gp_file_get_name(self._cf, PTR(name)))
         return name.value
     def _set_name(self, name):
-        check(gp.gp_file_set_name(self._cf, str(name)))
+        check(gp.gp_file_set_name(self._cf, _b(name)))
     name = property(_get_name, _set_name)
 
-    # TODO: new_from_fd (?), new_from_handler (?), mime_tipe, mtime, detect_mime_type, adjust_name_for_mime_type, data_and_size, append, slurp, python file object?
+    # TODO: mime_tipe, mtime, detect_mime_type, adjust_name_for_mime_type, append, slurp, python file object?
+
+_handler_size_func = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint64))
+_handler_io_func = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(ctypes.c_ubyte),
+                                    ctypes.POINTER(ctypes.c_uint64))
+
+class CameraFileHandler(ctypes.Structure):
+    _fields_ = [('size', _handler_size_func),
+                ('read', _handler_io_func),
+                ('write', _handler_io_func)]
+
+def _file_handler(writer):
+    """A write-only CameraFileHandler passing each chunk to writer(bytes)"""
+    def size(priv, size):
+        return GP_ERROR_NOT_SUPPORTED
+    def read(priv, data, length):
+        return GP_ERROR_NOT_SUPPORTED
+    def write(priv, data, length):
+        try:
+            writer(ctypes.string_at(data, length[0]))
+        except Exception as e:
+            print("cameraFile writer failed: %s" % e)
+            return GP_ERROR
+        return GP_OK
+    callbacks = (_handler_size_func(size), _handler_io_func(read), _handler_io_func(write))
+    handler = CameraFileHandler(*callbacks)
+    # libgphoto2 only sees raw function pointers, keep the Python side alive with the struct
+    handler._callbacks = callbacks
+    return handler
 
 class cameraAbilitiesList(object):
     _static_l = None
@@ -412,7 +806,7 @@ class cameraAbilitiesList(object):
         if cameraAbilitiesList._static_l is None:
             cameraAbilitiesList._static_l = ctypes.c_void_p()
             check(gp.gp_abilities_list_new(PTR(cameraAbilitiesList._static_l)))
-            check(gp.gp_abilities_list_load(cameraAbilitiesList._static_l, context))
+            check(gp.gp_abilities_list_load(cameraAbilitiesList._static_l, gp.context))
         self._l = cameraAbilitiesList._static_l
 
     def __del__(self):
@@ -421,7 +815,7 @@ class cameraAbilitiesList(object):
         pass
 
     def detect(self, il, l):
-        check(gp.gp_abilities_list_detect(self._l, il._l, l._l, context))
+        check(gp.gp_abilities_list_detect(self._l, il._l, l._l, gp.context))
 
     def lookup_model(self, model):
         return check(gp.gp_abilities_list_lookup_model(self._l, model))
@@ -475,7 +869,7 @@ class portInfoList(object):
         return index
 
     def get_info(self, path_index):
-        info = PortInfo()
+        info = _port_info_class()()
         check(gp.gp_port_info_list_get_info(self._l, path_index, PTR(info)))
         return info
 
@@ -486,7 +880,7 @@ class cameraList(object):
 
         if autodetect == True:
             if hasattr(gp, 'gp_camera_autodetect'):
-                gp.gp_camera_autodetect(self._l, context)
+                gp.gp_camera_autodetect(self._l, gp.context)
             else:
                 # this is for stable versions of gphoto <= 2.4.10.1
                 xlist = cameraList()
@@ -520,7 +914,7 @@ class cameraList(object):
         check(gp.gp_list_reset(self._l))
 
     def append(self, name, value):
-        check(gp.gp_list_append(self._l, str(name), str(value)))
+        check(gp.gp_list_append(self._l, _b(name), _b(value)))
 
     def sort(self):
         check(gp.gp_list_sort(self._l))
@@ -530,7 +924,7 @@ class cameraList(object):
 
     def find_by_name(self, name):
         index = ctypes.c_int()
-        check(gp.gp_list_find_by_name(self._l, PTR(index), str(name)))
+        check(gp.gp_list_find_by_name(self._l, PTR(index), _b(name)))
         return index.value
 
     def get_name(self, index):
@@ -544,10 +938,10 @@ class cameraList(object):
         return value.value
 
     def set_name(self, index, name):
-        check(gp.gp_list_set_name(self._l, int(index), str(name)))
+        check(gp.gp_list_set_name(self._l, int(index), _b(name)))
 
     def set_value(self, index, value):
-        check(gp.gp_list_set_value(self._l, int(index), str(value)))
+        check(gp.gp_list_set_value(self._l, int(index), _b(value)))
 
     def __str__(self):
         header = "cameraList object with %d elements:\n" % self.count()
@@ -575,7 +969,7 @@ class cameraWidget(object):
     def __init__(self, type = None, label = ""):
         self._w = ctypes.c_void_p()
         if type is not None:
-            check(gp.gp_widget_new(int(type), str(label), PTR(self._w)))
+            check(gp.gp_widget_new(int(type), _b(label), PTR(self._w)))
             check(gp.gp_widget_ref(self._w))
         else:
             self._w = ctypes.c_void_p()
@@ -597,7 +991,7 @@ class cameraWidget(object):
         check(gp.gp_widget_get_info(self._w, PTR(info)))
         return info.value
     def _set_info(self, info):
-        check(gp.gp_widget_set_info(self._w, str(info)))
+        check(gp.gp_widget_set_info(self._w, _b(info)))
     info = property(_get_info, _set_info)
 
     def _get_name(self):
@@ -605,7 +999,7 @@ class cameraWidget(object):
         check(gp.gp_widget_get_name(self._w, PTR(name)))
         return name.value
     def _set_name(self, name):
-        check(gp.gp_widget_set_name(self._w, str(name)))
+        check(gp.gp_widget_set_name(self._w, _b(name)))
     name = property(_get_name, _set_name)
 
     def _get_id(self):
@@ -615,7 +1009,7 @@ class cameraWidget(object):
     id = property(_get_id, None)
 
     def _set_changed(self, changed):
-        check(gp.gp_widget_set_changed(self._w, str(changed)))
+        check(gp.gp_widget_set_changed(self._w, int(changed)))
     def _get_changed(self):
         return gp.gp_widget_changed(self._w)
     changed = property(_get_changed, _set_changed)
@@ -643,7 +1037,7 @@ class cameraWidget(object):
         check(gp.gp_widget_get_label(self._w, PTR(label)))
         return label.value
     def _set_label(self, label):
-        check(gp.gp_widget_set_label(self._w, str(label)))
+        check(gp.gp_widget_set_label(self._w, _b(label)))
     label = property(_get_label, _set_label)
 
     def _get_value(self):
@@ -683,13 +1077,13 @@ class cameraWidget(object):
 
     def get_child(self, child_number):
         w = cameraWidget()
+        # Children belong to the root widget and go when it does, so no ref here
         check(gp.gp_widget_get_child(self._w, int(child_number), PTR(w._w)))
-        check(gp.gp_widget_ref(w._w))
         return w
 
     def get_child_by_label(self, label):
         w = cameraWidget()
-        check(gp.gp_widget_get_child_by_label(self._w, str(label), PTR(w._w)))
+        check(gp.gp_widget_get_child_by_label(self._w, _b(label), PTR(w._w)))
         return w
 
     def get_child_by_id(self, id):
@@ -700,7 +1094,7 @@ class cameraWidget(object):
     def get_child_by_name(self, name):
         w = cameraWidget()
         # this fails in 2.4.6 (Ubuntu 9.10)
-        check(gp.gp_widget_get_child_by_name(self._w, str(name), PTR(w._w)))
+        check(gp.gp_widget_get_child_by_name(self._w, _b(name), PTR(w._w)))
         return w
 
     def _get_children(self):
@@ -736,7 +1130,7 @@ class cameraWidget(object):
     range = property(_get_range, _set_range)
 
     def add_choice(self, choice):
-        check(gp.gp_widget_add_choice(self._w, str(choice)))
+        check(gp.gp_widget_add_choice(self._w, _b(choice)))
 
     def count_choices(self, choice):
         return gp.gp_widget_count_choices(self._w)
@@ -785,3 +1179,326 @@ class cameraWidget(object):
 
 class cameraWidgetSimple(object):
     pass
+
+def _widget_string(w, getter):
+    value = ctypes.c_char_p()
+    check(getter(w, PTR(value)))
+    return value.value.decode() if value.value is not None else None
+
+def _widget_type(w):
+    type = ctypes.c_int()
+    check(gp.gp_widget_get_type(w, PTR(type)))
+    return type.value
+
+def _write_widget_value(w, type, value):
+    """Set a widget's value from a Python value, which also marks it changed"""
+    if type in (GP_WIDGET_MENU, GP_WIDGET_RADIO, GP_WIDGET_TEXT):
+        value = ctypes.c_char_p(_b(value))
+    elif type == GP_WIDGET_RANGE:
+        value = PTR(ctypes.c_float(float(value)))
+    elif type in (GP_WIDGET_TOGGLE, GP_WIDGET_DATE):
+        value = PTR(ctypes.c_int(int(value)))
+    else:
+        raise ValueError('Widget of type %s has no value to set' % widget_types[type])
+    check(gp.gp_widget_set_value(w, value))
+
+def _read_widget_value(w, type):
+    """Read a widget's value as the Python type matching its widget type"""
+    if type in (GP_WIDGET_MENU, GP_WIDGET_RADIO, GP_WIDGET_TEXT):
+        value = ctypes.c_char_p()
+        check(gp.gp_widget_get_value(w, PTR(value)))
+        return value.value.decode() if value.value is not None else None
+    elif type == GP_WIDGET_RANGE:
+        value = ctypes.c_float()
+        check(gp.gp_widget_get_value(w, PTR(value)))
+        return value.value
+    elif type in (GP_WIDGET_TOGGLE, GP_WIDGET_DATE):
+        value = ctypes.c_int()
+        check(gp.gp_widget_get_value(w, PTR(value)))
+        return value.value
+    return None
+
+def _read_config_tree(w, parent_path):
+    """Copy a widget and everything under it into configNodes in one pass"""
+    node = configNode()
+    node.name = _widget_string(w, gp.gp_widget_get_name)
+    node.path = parent_path + "." + node.name if parent_path else node.name
+    node.label = _widget_string(w, gp.gp_widget_get_label)
+    node.type = _widget_type(w)
+    readonly = ctypes.c_int()
+    check(gp.gp_widget_get_readonly(w, PTR(readonly)))
+    node.readonly = bool(readonly.value)
+    node.value = _read_widget_value(w, node.type)
+    node.choices = ()
+    if node.type in (GP_WIDGET_MENU, GP_WIDGET_RADIO):
+        choices = []
+        for i in range(check(gp.gp_widget_count_choices(w))):
+            choice = ctypes.c_char_p()
+            check(gp.gp_widget_get_choice(w, i, PTR(choice)))
+            choices.append(choice.value.decode())
+        node.choices = tuple(choices)
+    node._w = ctypes.c_void_p(w.value)
+    children = []
+    for i in range(check(gp.gp_widget_count_children(w))):
+        child = ctypes.c_void_p()
+        check(gp.gp_widget_get_child(w, i, PTR(child)))
+        children.append(_read_config_tree(child, node.path))
+    node.children = tuple(children)
+    return node
+
+class configNode(object):
+    __slots__ = ('path', 'name', 'label', 'type', 'value', 'readonly', 'choices', 'children', '_w')
+
+    def _get_typestr(self):
+        return widget_types[self.type]
+    typestr = property(_get_typestr, None)
+
+    def __repr__(self):
+        return "%s:%s:%s:%s" % (self.label, self.path, self.typestr, self.value)
+
+class cameraProfile(object):
+    """A named set of camera settings, e.g. 'attract' and 'shoot'.
+    Settings are keyed by bare name or dotted path."""
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = dict(settings)
+
+    @classmethod
+    def from_config(cls, name, cfg, settings = None):
+        if settings is None:
+            settings = profile_settings
+        return cls(name, [(s, cfg.find(s).value) for s in settings if s in cfg.names or s in cfg.index])
+
+    def diff(self, cfg):
+        """Returns (node, value) for each setting that differs from the snapshot.
+        Settings this camera doesn't have (e.g. a profile saved on another body) are skipped."""
+        changes = []
+        for (setting, value) in sorted(self.settings.items()):
+            try:
+                node = cfg.find(setting)
+            except KeyError:
+                print("Profile %s: camera has no setting %s, skipping it" % (self.name, setting))
+                continue
+            if node.type == GP_WIDGET_RANGE:
+                same = node.value is not None and abs(node.value - float(value)) < 1e-6
+            elif node.type in (GP_WIDGET_TOGGLE, GP_WIDGET_DATE):
+                same = node.value == int(value)
+            else:
+                same = node.value == value
+            if not same:
+                changes.append((node, value))
+        return changes
+
+    def __repr__(self):
+        return "cameraProfile(%r, %r)" % (self.name, self.settings)
+
+def load_profiles(path):
+    """Read {name: cameraProfile} from a JSON file of {name: {setting: value}}"""
+    with open(path) as f:
+        return dict((name, cameraProfile(name, settings)) for (name, settings) in json.load(f).items())
+
+def save_profiles(path, profiles):
+    with open(path, 'w') as f:
+        json.dump(dict((p.name, p.settings) for p in profiles.values()), f, indent = 2, sort_keys = True)
+
+class cameraConfig(object):
+    """A snapshot of the camera config, indexed by dotted path.
+
+        cfg = cam.config_snapshot()
+        cfg['main.settings.capturetarget'].value
+        cfg.find('capturetarget').value
+
+    Values are read when the snapshot is taken, later changes on the camera
+    need a fresh snapshot. The underlying widget tree is held until close().
+    """
+    def __init__(self, root, handle = None):
+        self.root = root
+        self._handle = handle
+        self.index = {}
+        self.names = {}
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            self.index[node.path] = node
+            self.names.setdefault(node.name, node)
+            stack.extend(reversed(node.children))
+
+    def __getitem__(self, path):
+        return self.index[path]
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __iter__(self):
+        """The leaf settings, in tree order"""
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(reversed(node.children))
+            else:
+                yield node
+
+    def get(self, path, default = None):
+        return self.index.get(path, default)
+
+    def find(self, name):
+        """Look up by dotted path, or by bare setting name like 'iso'"""
+        node = self.index.get(name)
+        if node is None:
+            node = self.names[name]
+        return node
+
+    def values(self):
+        return dict((node.path, node.value) for node in self)
+
+    def close(self):
+        if self._handle:
+            gp.gp_widget_free(self._handle)
+            self._handle = None
+
+    def __del__(self):
+        self.close()
+
+_libc_dll = []
+def _libc():
+    if not _libc_dll:
+        libc = ctypes.CDLL(None)
+        libc.free.argtypes = [ctypes.c_void_p]
+        libc.free.restype = None
+        _libc_dll.append(libc)
+    return _libc_dll[0]
+
+class cameraEvent(object):
+    __slots__ = ('type', 'folder', 'name', 'data')
+
+    def __init__(self, type, folder = None, name = None, data = None):
+        self.type = type
+        self.folder = folder
+        self.name = name
+        self.data = data
+
+    def _get_typestr(self):
+        return event_types[self.type] if 0 <= self.type < len(event_types) else str(self.type)
+    typestr = property(_get_typestr, None)
+
+    def __repr__(self):
+        if self.folder is not None:
+            return "%s:%s/%s" % (self.typestr, self.folder, self.name)
+        return "%s:%s" % (self.typestr, self.data)
+
+class capturePipeline(object):
+    """Event driven shooting: trigger now, download whenever the file turns up.
+
+    trigger() fires the shutter and returns straight away. poll() pumps the
+    camera's event queue and downloads each new file as its FILE_ADDED event
+    arrives, so the next trigger can go out while the last shot is still on
+    its way. New files are matched to triggers in order.
+
+    destpath for a trigger is either a path, or a callable taking
+    (folder, name) and returning a path, or None to leave that file on the
+    camera. files_per_shot covers cameras set to e.g. RAW + JPEG.
+
+    Files that turn up with no shot waiting for them, or that belong to a
+    shot expire() already gave up on, are left on the camera rather than
+    being handed to the next shot.
+    """
+    def __init__(self, camera, files_per_shot = 1):
+        self.camera = camera
+        self.files_per_shot = files_per_shot
+        self._pending = deque()  # [token, destpath, files still to come, trigger time]
+        # [files, until] still owed by shots expire() gave up on. They arrive ahead of the
+        # next shot's files, unless they never come at all, so each is only waited for until `until`
+        self._stale = deque()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def drain(self):
+        """Throw away whatever the camera has queued up, when no shot is waiting.
+        Returns the (folder, name) of each file left on the camera."""
+        ignored = []
+        if self._pending:
+            return ignored
+        while True:
+            event = self.camera.wait_for_event(0)
+            if event.type == GP_EVENT_TIMEOUT:
+                break
+            if event.type == GP_EVENT_FILE_ADDED:
+                self._take_stale()
+                ignored.append((event.folder, event.name))
+        return ignored
+
+    def _take_stale(self):
+        """Count a new file against the expired shots. True if it was one of theirs"""
+        now = time.time()
+        while self._stale and self._stale[0][1] < now:
+            self._stale.popleft()
+        if not self._stale:
+            return False
+        self._stale[0][0] -= 1
+        if self._stale[0][0] <= 0:
+            self._stale.popleft()
+        return True
+
+    def trigger(self, destpath, token = None):
+        self.drain()
+        self.camera.trigger_capture()
+        self._pending.append([token, destpath, self.files_per_shot, time.time()])
+
+    def expire(self, max_age):
+        """Give up on shots triggered more than max_age seconds ago whose files
+        never showed up. Returns their tokens."""
+        expired = []
+        while self._pending and time.time() - self._pending[0][3] > max_age:
+            shot = self._pending.popleft()
+            self._stale.append([shot[2], time.time() + max_age])
+            expired.append(shot[0])
+        return expired
+
+    def poll(self, timeout = 100):
+        """Handle events for up to timeout ms, stopping early once an event times out.
+        Returns (done, failed): (token, folder, name, destpath) for each file handled,
+        and (token, folder, name, error) for each file whose download failed. Either
+        way the file counts towards its shot."""
+        done = []
+        failed = []
+        deadline = time.time() + timeout / 1000.0
+        while self._pending:
+            remaining = max(0, int((deadline - time.time()) * 1000))
+            event = self.camera.wait_for_event(remaining)
+            if event.type == GP_EVENT_TIMEOUT:
+                break
+            if event.type == GP_EVENT_FILE_ADDED and self._take_stale():
+                pass  # Late file from a shot that was given up on, leave it on the camera
+            elif event.type == GP_EVENT_FILE_ADDED:
+                shot = self._pending[0]
+                (token, destpath) = shot[0:2]
+                if callable(destpath):
+                    destpath = destpath(event.folder, event.name)
+                try:
+                    if destpath:
+                        self.camera.download_file(event.folder, event.name, destpath)
+                    done.append((token, event.folder, event.name, destpath))
+                except libgphoto2error as e:
+                    failed.append((token, event.folder, event.name, e))
+                shot[2] -= 1
+                if shot[2] <= 0:
+                    self._pending.popleft()
+            if remaining == 0:
+                break
+        return (done, failed)
+
+def __getattr__(name):
+    # Kept for code that used the old eagerly created module globals
+    if name == 'context':
+        return gp.context
+    if name == 'PortInfo':
+        return _port_info_class()
+    import importlib
+    ptp = importlib.import_module(__name__ + '.ptp')
+    try:
+        return getattr(ptp, name)
+    except AttributeError:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,288 @@
+# fake.py
+# A stand-in for piggyphoto.camera that needs neither libgphoto2 nor a camera.
+# Preview frames and captures are served from JPEGs on disk, with optional
+# latency and failure injection so the booth can be run and benchmarked on
+# a dev box.
+
+import os
+import time
+import random
+import shutil
+from collections import deque
+from contextlib import contextmanager
+
+from . import libgphoto2error, cameraConfig, configNode, cameraProfile, cameraEvent
+from . import GP_EVENT_TIMEOUT, GP_EVENT_FILE_ADDED, GP_EVENT_CAPTURE_COMPLETE
+from . import GP_WIDGET_WINDOW, GP_WIDGET_SECTION, GP_WIDGET_TEXT, GP_WIDGET_RADIO
+
+GP_ERROR = -1
+FAKE_FOLDER = '/store_00010001/DCIM/100CANON'
+RAM_FOLDER = '/'
+
+
+class directorySource(object):
+    """Cycles through the JPEGs in a directory, in name order.
+    The files are read once and kept in memory."""
+    def __init__(self, path):
+        names = sorted(n for n in os.listdir(path) if n.lower().endswith(('.jpg', '.jpeg')))
+        if not names:
+            raise ValueError('No JPEGs found in %s' % path)
+        self.paths = [os.path.join(path, n) for n in names]
+        self._frames = [open(p, 'rb').read() for p in self.paths]
+        self._index = 0
+
+    def next_frame(self):
+        data = self._frames[self._index]
+        self._index = (self._index + 1) % len(self._frames)
+        return data
+
+
+class fakeCameraFile(object):
+    """Same surface as cameraFile, over an in-memory buffer"""
+    def __init__(self, data = b'', name = 'preview.jpg'):
+        self.data = data
+        self.name = name
+
+    def save(self, filename = None):
+        if filename is None: filename = self.name
+        with open(filename, 'wb') as f:
+            f.write(self.data)
+
+    def clean(self):
+        self.data = b''
+
+    def free(self):
+        self.data = b''
+
+    def __dealoc__(self, filename = None):
+        self.free()
+
+
+class fakeWidget(object):
+    """Just enough of cameraWidget to walk a config tree"""
+    def __init__(self, name, value = None, children = (), choices = (), label = None):
+        self.name = name
+        self.label = label or name
+        self.value = value
+        self.children = list(children)
+        self.choices = list(choices)
+        if self.children:
+            self.type = GP_WIDGET_SECTION
+        else:
+            self.type = GP_WIDGET_RADIO if self.choices else GP_WIDGET_TEXT
+        self.typestr = 'Section' if self.children else ('Radio' if self.choices else 'Text')
+
+    def count_children(self):
+        return len(self.children)
+
+    def get_child_by_name(self, name):
+        for c in self.children:
+            if c.name == name:
+                return c
+            if c.children:
+                try:
+                    return c.get_child_by_name(name)
+                except KeyError:
+                    pass
+        raise KeyError(name)
+
+    def __repr__(self):
+        return "%s:%s:%s:%s" % (self.label, self.name, self.typestr, self.value)
+
+
+def _snapshot(widget, parent_path):
+    node = configNode()
+    node.name = widget.name
+    node.path = parent_path + "." + widget.name if parent_path else widget.name
+    node.label = widget.label
+    node.type = GP_WIDGET_WINDOW if not parent_path else widget.type
+    node.value = widget.value
+    node.readonly = False
+    node.choices = tuple(widget.choices)
+    node.children = tuple(_snapshot(c, node.path) for c in widget.children)
+    node._w = widget
+    return node
+
+
+def default_config():
+    return fakeWidget('main', children = [
+        fakeWidget('settings', children = [
+            fakeWidget('capturetarget', 'Memory card', choices = ['Internal RAM', 'Memory card']),
+        ]),
+        fakeWidget('status', children = [
+            fakeWidget('batterylevel', '100%'),
+        ]),
+        fakeWidget('imgsettings', children = [
+            fakeWidget('imageformat', 'Large Fine JPEG', choices = [
+                'Large Fine JPEG', 'Large Normal JPEG', 'Medium Fine JPEG', 'Medium Normal JPEG',
+                'Small Fine JPEG', 'Small Normal JPEG', 'RAW + Large Fine JPEG', 'RAW + Small Fine JPEG', 'RAW']),
+            fakeWidget('iso', '400', choices = ['Auto', '100', '200', '400', '800', '1600', '3200']),
+        ]),
+        fakeWidget('capturesettings', children = [
+            fakeWidget('shutterspeed', '1/60', choices = ['1/30', '1/60', '1/125', '1/250']),
+            fakeWidget('aperture', '5.6', choices = ['4', '5.6', '8', '11']),
+        ]),
+    ])
+
+
+class fakeCamera(object):
+    """Drop-in replacement for piggyphoto.camera.
+
+    preview_source is either a directory of JPEGs or anything with a
+    next_frame() method returning JPEG bytes. Captures come from the JPEGs in
+    capture_dir (the preview directory if not given). Each call sleeps for the
+    matching *_latency in seconds, and fails with libgphoto2error with
+    probability failure_rate.
+    """
+    def __init__(self, preview_source, capture_dir = None, preview_latency = 0.0,
+                 capture_latency = 0.0, download_latency = 0.0, failure_rate = 0.0, seed = None):
+        if isinstance(preview_source, str):
+            preview_source = directorySource(preview_source)
+        self.preview_source = preview_source
+        if capture_dir is None:
+            capture_dir = getattr(preview_source, 'paths', None) and os.path.dirname(preview_source.paths[0])
+        self.captures = directorySource(capture_dir) if capture_dir else None
+        self.preview_latency = preview_latency
+        self.capture_latency = capture_latency
+        self.download_latency = download_latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._card = {}  # (folder, name) -> source path
+        self._shot = 0
+        self._events = deque()
+        self.initialized = True
+        self._config = default_config()
+
+    def _call(self, latency, what):
+        if latency:
+            time.sleep(latency)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            raise libgphoto2error(GP_ERROR, 'Fake %s failure' % what)
+
+    def init(self):
+        self.initialized = True
+
+    def exit(self):
+        pass
+
+    def leave_locked(self):
+        pass
+
+    def _get_config(self):
+        return self._config
+    def _set_config(self, window):
+        self._config = window
+    config = property(_get_config, _set_config)
+
+    def capture_preview(self, destpath = None):
+        self._call(self.preview_latency, 'capture_preview')
+        cfile = fakeCameraFile(self.preview_source.next_frame())
+        if destpath:
+            cfile.save(destpath)
+        else:
+            return cfile
+
+    @contextmanager
+    def preview(self):
+        cfile = self.capture_preview()
+        try:
+            yield cfile
+        finally:
+            cfile.free()
+
+    def _shoot(self, what):
+        """Returns the (folder, name) of every file the shot made, JPEG last.
+        Follows capturetarget and imageformat like a Canon would: internal RAM
+        files turn up in / as capt*.jpg, RAW + JPEG adds a .CR2 alongside.
+        The RAW is a copy of the JPEG, it only has to take up room."""
+        if self.captures is None:
+            raise libgphoto2error(GP_ERROR, 'Fake camera has nothing to capture from')
+        self._call(self.capture_latency, what)
+        source = self.captures.paths[self._shot % len(self.captures.paths)]
+        self._shot += 1
+        if self.get_setting('capturetarget') == 'Internal RAM':
+            (folder, stem, ext) = (RAM_FOLDER, 'capt%04d' % self._shot, '.jpg')
+        else:
+            (folder, stem, ext) = (FAKE_FOLDER, 'IMG_%04d' % self._shot, '.JPG')
+        files = [(folder, stem + ext)]
+        if self.get_setting('imageformat').startswith('RAW +'):
+            files.insert(0, (folder, stem + '.CR2'))
+        for path in files:
+            self._card[path] = source
+        return files
+
+    def trigger_capture(self):
+        for (folder, name) in self._shoot('trigger_capture'):
+            self._events.append(cameraEvent(GP_EVENT_FILE_ADDED, folder, name))
+        self._events.append(cameraEvent(GP_EVENT_CAPTURE_COMPLETE))
+
+    def wait_for_event(self, timeout):
+        if self._events:
+            return self._events.popleft()
+        time.sleep(timeout / 1000.0)
+        return cameraEvent(GP_EVENT_TIMEOUT)
+
+    def capture_image(self, destpath = None):
+        (folder, name) = self._shoot('capture_image')[-1]
+        if destpath:
+            self.download_file(folder, name, destpath)
+        else:
+            return (folder, name)
+
+    def _source(self, folder, name):
+        try:
+            return self._card[(folder, name)]
+        except KeyError:
+            raise libgphoto2error(GP_ERROR, 'No such file %s/%s' % (folder, name))
+
+    def download_file(self, srcfolder, srcfilename, destpath):
+        self._call(self.download_latency, 'download_file')
+        source = self._source(srcfolder, srcfilename)
+        shutil.copyfile(source, destpath)
+
+    def download_to(self, srcfolder, srcfilename, fileobj):
+        self._call(self.download_latency, 'download_to')
+        source = self._source(srcfolder, srcfilename)
+        with open(source, 'rb') as f:
+            shutil.copyfileobj(f, fileobj)
+
+    def file_size(self, folder, name):
+        return os.path.getsize(self._source(folder, name))
+
+    def delete_file(self, folder, name):
+        self._call(0, 'delete_file')
+        self._source(folder, name)
+        del self._card[(folder, name)]
+
+    def list_folders(self, path = "/"):
+        path = path.rstrip('/')
+        folders = set()
+        for (folder, name) in self._card:
+            if folder.startswith(path + '/'):
+                folders.add(folder[len(path) + 1:].split('/')[0])
+        return [(f, None) for f in sorted(folders)]
+
+    def list_files(self, path = "/"):
+        path = path.rstrip('/') or '/'
+        return [(name, None) for (folder, name) in sorted(self._card) if folder == path]
+
+    def get_setting(self, name):
+        return self._config.get_child_by_name(name.split('.')[-1]).value
+
+    def set_setting(self, name, value):
+        self._config.get_child_by_name(name.split('.')[-1]).value = value
+
+    def save_profile(self, name, settings = None):
+        return cameraProfile.from_config(name, self.config_snapshot(), settings)
+
+    def apply_profile(self, profile):
+        changes = profile.diff(self.config_snapshot())
+        for (node, value) in changes:
+            node._w.value = value
+        return [node.path for (node, value) in changes]
+
+    def config_snapshot(self):
+        return cameraConfig(_snapshot(self._config, ''))
+
+    def list_config(self):
+        return [node.path for node in self.config_snapshot()]
@@ -0,0 +1,163 @@
+# recorder.py
+# Records the raw JPEG preview stream coming off a camera into a single
+# append-only file, and plays it back through the same interface.
+#
+# The stream file is a magic header followed by one record per frame:
+#   <float64 timestamp> <uint32 length> <length bytes of JPEG>
+# Alongside it, '<stream>.idx' gets one <uint64 offset> <float64 timestamp>
+# <uint32 length> entry per frame. Both are only ever appended to, so a
+# recording cut short by a crash is still readable, and a missing or short
+# index is rebuilt by scanning the stream.
+
+import os
+import time
+import struct
+import threading
+from contextlib import contextmanager
+
+from .fake import fakeCameraFile
+
+MAGIC = b'PIGGYREC1\n'
+RECORD = struct.Struct('<dI')
+INDEX = struct.Struct('<QdI')
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+class previewRecorder(object):
+    """Wraps a camera so every capture_preview() frame is also written to disk.
+    Everything else is passed straight through to the wrapped camera."""
+    def __init__(self, camera, path):
+        self.camera = camera
+        self.path = path
+        self._lock = threading.Lock()
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._stream = open(path, 'ab')
+        self._index = open(index_path(path), 'ab')
+        if new:
+            self._stream.write(MAGIC)
+        self.frames = 0
+
+    def __getattr__(self, name):
+        return getattr(self.camera, name)
+
+    def record(self, data, timestamp = None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            offset = self._stream.tell()
+            self._stream.write(RECORD.pack(timestamp, len(data)))
+            self._stream.write(data)
+            self._stream.flush()
+            self._index.write(INDEX.pack(offset, timestamp, len(data)))
+            self._index.flush()
+            self.frames += 1
+
+    @contextmanager
+    def preview(self):
+        with self.camera.preview() as cfile:
+            self.record(cfile.data)
+            yield cfile
+
+    def capture_preview(self, destpath = None):
+        cfile = self.camera.capture_preview()
+        try:
+            data = cfile.data
+        finally:
+            cfile.free()
+        self.record(data)
+        cfile = fakeCameraFile(data)
+        if destpath:
+            cfile.save(destpath)
+        else:
+            return cfile
+
+    def close(self):
+        with self._lock:
+            self._stream.close()
+            self._index.close()
+
+
+def read_index(path):
+    """Returns a list of (offset, timestamp, length) for every frame in a recording"""
+    entries = []
+    if os.path.exists(index_path(path)):
+        with open(index_path(path), 'rb') as f:
+            raw = f.read()
+        usable = len(raw) - len(raw) % INDEX.size
+        entries = [INDEX.unpack_from(raw, i) for i in range(0, usable, INDEX.size)]
+    # Pick up anything written after the last index entry, or the lot if there's no index
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if not entries:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a preview recording' % path)
+            offset = len(MAGIC)
+        else:
+            offset = entries[-1][0] + RECORD.size + entries[-1][2]
+        while offset + RECORD.size <= size:
+            f.seek(offset)
+            (timestamp, length) = RECORD.unpack(f.read(RECORD.size))
+            if offset + RECORD.size + length > size:
+                break  # Truncated last frame
+            entries.append((offset, timestamp, length))
+            offset += RECORD.size + length
+    return entries
+
+
+class recordedSource(object):
+    """Plays a recording back as a fakeCamera preview source.
+
+    With realtime set, next_frame() paces itself to the gaps between the
+    recorded timestamps, otherwise frames come back as fast as they're asked
+    for. With loop set, playback starts again from the top at the end.
+
+    Recordings are appended to, so one file can hold several runs. A gap of
+    more than max_gap seconds between two frames (or a step backwards) is
+    taken as the start of a new run, and pacing starts over from there
+    rather than sleeping through the time between runs.
+    """
+    max_gap = 2.0
+
+    def __init__(self, path, realtime = True, loop = True):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.index = read_index(path)
+        if not self.index:
+            raise ValueError('%s has no frames' % path)
+        self._file = open(path, 'rb')
+        self._position = 0
+        self._started = None
+        self._base = 0  # frame the current stretch of pacing is timed from
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame(self, number):
+        (offset, timestamp, length) = self.index[number]
+        self._file.seek(offset + RECORD.size)
+        return self._file.read(length)
+
+    def next_frame(self):
+        if self._position >= len(self.index):
+            if not self.loop:
+                raise EOFError('End of recording %s' % self.path)
+            self._position = 0
+            self._started = None
+        number = self._position
+        self._position += 1
+        if self.realtime:
+            now = time.time()
+            if number > 0:
+                gap = self.index[number][1] - self.index[number - 1][1]
+                if gap < 0 or gap > self.max_gap:
+                    self._started = None
+            if self._started is None:
+                (self._started, self._base) = (now, number)
+            delay = (self.index[number][1] - self.index[self._base][1]) - (now - self._started)
+            if delay > 0:
+                time.sleep(delay)
+        return self.frame(number)
@@ -0,0 +1,164 @@
+import io
+import math
+import time
+import threading
+
+import pygame
+from PIL import Image
+
+
+class FrameSlot(object):
+    """Single frame buffer where the newest frame always wins.
+
+    The producer overwrites whatever is in the slot, the consumer takes a look
+    at the latest frame without ever waiting on the producer.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frame = None
+        self._sequence = 0
+
+    def put(self, frame):
+        with self._lock:
+            self._frame = frame
+            self._sequence += 1
+
+    def latest(self):
+        """Returns (sequence, frame). The sequence only changes when a new frame lands"""
+        with self._lock:
+            return (self._sequence, self._frame)
+
+
+def draft(image, size):
+    """Have a JPEG decode at the smallest DCT reduction (1/2, 1/4 or 1/8)
+    still at least size, so any resize after only has the leftover to do."""
+    image.draft('RGB', size)
+    return image
+
+
+def decode_preview(data, fit_width=None, rotation=0):
+    """Decode a JPEG preview frame into a pygame Surface. If fit_width is
+    given, the frame is destined to be scaled to that width (after rotation)."""
+    image = Image.open(io.BytesIO(data))
+    if fit_width:
+        (width, height) = image.size
+        rotated_width = height if rotation % 180 else width
+        scale = float(fit_width) / rotated_width
+        if scale < 1:
+            draft(image, (int(math.ceil(width * scale)), int(math.ceil(height * scale))))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return pygame.image.fromstring(image.tobytes(), image.size, 'RGB')
+
+
+class PreviewWorker(threading.Thread):
+    """Pulls preview frames off the camera as fast as it will deliver them.
+
+    Anything else that talks to the camera (e.g. taking the actual photo) must
+    hold camera_lock while it does so. If timings is given, the capture and
+    decode time of each frame is passed to timings.record().
+    """
+    def __init__(self, camera, slot=None, fit_width=None, rotation=0, timings=None, retry_delay=0.5):
+        super(PreviewWorker, self).__init__(name='PreviewWorker')
+        self.daemon = True
+        self.camera = camera
+        self.fit_width = fit_width
+        self.rotation = rotation
+        self.timings = timings
+        self.slot = slot if slot is not None else FrameSlot()
+        self.camera_lock = threading.RLock()
+        self.retry_delay = retry_delay
+        self._running = threading.Event()
+        self._running.set()
+
+    def capture_data(self):
+        """Grab a preview frame from the camera as raw JPEG bytes"""
+        with self.camera_lock:
+            with self.camera.preview() as camera_file:
+                return camera_file.data
+
+    def run(self):
+        while self._running.is_set():
+            try:
+                start = time.time()
+                data = self.capture_data()
+                captured = time.time()
+                self.slot.put(decode_preview(data, self.fit_width, self.rotation))
+                if self.timings is not None:
+                    self.timings.record('capture', captured - start)
+                    self.timings.record('decode', time.time() - captured)
+            except Exception as e:
+                print('Preview capture failed: {}'.format(e))
+                time.sleep(self.retry_delay)
+
+    def stop(self):
+        self._running.clear()
+
+
+class TransformPlan(object):
+    """Rotate, scale and crop a preview frame to fit the screen in one go.
+
+    The plan works out up front which part of the source frame survives the
+    crop, so only those pixels get rotated, and the scale writes straight into
+    a destination surface that is allocated once and reused for every frame.
+    Plans are cached per (source size, screen size, rotation).
+    """
+    _plans = {}
+
+    def __init__(self, source_size, screen_size, rotation=0):
+        self.source_size = source_size
+        self.screen_size = screen_size
+        self.rotation = rotation % 360
+        (width, height) = source_size
+        (screen_width, screen_height) = screen_size
+        if self.rotation % 180:
+            (rotated_width, rotated_height) = (height, width)
+        else:
+            (rotated_width, rotated_height) = (width, height)
+        # Fit to the width of the screen, crop or letterbox top and bottom
+        scale = float(screen_width) / rotated_width
+        scaled_height = int(rotated_height * scale)
+        if scaled_height > screen_height:
+            visible = min(rotated_height, int(round(screen_height / scale)))
+            top = (rotated_height - visible) // 2
+            self.dest_size = (screen_width, screen_height)
+            self.offset = (0, 0)
+        else:
+            visible = rotated_height
+            top = 0
+            self.dest_size = (screen_width, scaled_height)
+            self.offset = (0, (screen_height - scaled_height) // 2)
+        self.source_rect = self._source_rect(top, visible)
+        self.dest = None
+
+    def _source_rect(self, top, visible):
+        """Map the visible rows of the rotated frame back onto the source frame"""
+        (width, height) = self.source_size
+        if self.rotation == 270:  # Clockwise
+            return pygame.Rect(top, 0, visible, height)
+        elif self.rotation == 90:  # Anticlockwise
+            return pygame.Rect(width - top - visible, 0, visible, height)
+        elif self.rotation == 180:
+            return pygame.Rect(0, height - top - visible, width, visible)
+        elif self.rotation == 0:
+            return pygame.Rect(0, top, width, visible)
+        raise ValueError('Rotation must be a multiple of 90 degrees')
+
+    @classmethod
+    def get(cls, source_size, screen_size, rotation=0):
+        key = (tuple(source_size), tuple(screen_size), rotation)
+        plan = cls._plans.get(key)
+        if plan is None:
+            plan = cls._plans[key] = cls(*key)
+        return plan
+
+    def apply(self, frame):
+        """Returns (surface, position) ready to blit. The surface is reused by the next apply()"""
+        if self.dest is None:
+            self.dest = pygame.Surface(self.dest_size, 0, frame)
+        picture = frame.subsurface(self.source_rect)
+        if self.rotation:
+            # Quarter turns are a straight pixel copy, and only the visible part gets copied
+            picture = pygame.transform.rotate(picture, self.rotation)
+        pygame.transform.scale(picture, self.dest_size, self.dest)
+        return (self.dest, self.offset)
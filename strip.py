@@ -0,0 +1,371 @@
+import os
+import time
+import multiprocessing
+import threading
+import queue
+from concurrent.futures import ProcessPoolExecutor
+
+import PIL.Image
+import pygame
+
+from preview import draft
+
+# Quarter turns as lossless transposes, in degrees anticlockwise like Image.rotate
+TRANSPOSES = {0: None, 90: PIL.Image.ROTATE_90, 180: PIL.Image.ROTATE_180, 270: PIL.Image.ROTATE_270}
+SMALL_SUFFIX = '-small'
+SMALL_WIDTH = 600  # pixels across the small copy of a strip, for the web and previews
+
+
+def get_resize_transform(current, desired):
+    """Takes two dimension tuples in (w, h) form, and returns the dimension to scale to, and the number of pixels in each dimension to crop"""
+    if len(current) != 2 or len(desired) != 2:
+        raise ValueError('Current and desired must both contain exactly two dimensions')
+    w_ratio = float(desired[0])/current[0]
+    h_ratio = float(desired[1])/current[1]
+    scale_factor = max(w_ratio, h_ratio)
+    dims = (int(current[0] * scale_factor), int(current[1] * scale_factor))
+    w_crop = dims[0] - desired[0]
+    h_crop = dims[1] - desired[1]
+    crop = (int(w_crop), int(h_crop))
+    return (dims, crop)
+
+
+class StripLayout(object):
+    """Where the photos go on a strip template.
+
+    The template is divided into a grid of `columns` x `rows` equal cells,
+    inside a `margin` pixel border with `gutter` pixels between cells.
+    Photos fill the cells in reading order, leaving out the cells listed in
+    `reserved` as (column, row), negative from the right or bottom, which
+    are where the template has its own artwork. Photos are turned by
+    `rotation` degrees, anticlockwise, on the way in.
+
+    The reserved cells belong to the template, so if rows have to be added
+    the artwork stays where it is, and any cell of the new grid that would
+    cover it is left out too.
+    """
+    def __init__(self, template, columns, rows, margin=60, gutter=14, reserved=(), rotation=0):
+        self.template = template
+        self.columns = columns
+        self.rows = rows
+        self.margin = margin
+        self.gutter = gutter
+        self.reserved = reserved
+        self.rotation = rotation
+
+    def _grid(self, size, rows):
+        """Boxes (x, y, width, height) of every cell, by (column, row)"""
+        (width, height) = size
+        cell_width = (width - 2 * self.margin - (self.columns - 1) * self.gutter) // self.columns
+        cell_height = (height - 2 * self.margin - (rows - 1) * self.gutter) // rows
+        return dict(((column, row), (self.margin + column * (cell_width + self.gutter),
+                                     self.margin + row * (cell_height + self.gutter),
+                                     cell_width, cell_height))
+                    for row in range(rows) for column in range(self.columns))
+
+    def _cells(self, size, rows):
+        """Boxes of the cells free for photos, in reading order"""
+        base = self._grid(size, self.rows)
+        artwork = [base[(column % self.columns, row % self.rows)] for (column, row) in self.reserved]
+        grid = self._grid(size, rows)
+        cells = [grid[(column, row)] for row in range(rows) for column in range(self.columns)]
+        return [box for box in cells if not any(_overlap(box, other) for other in artwork)]
+
+    def compile(self, templates, shot_count, directory=''):
+        """Work out the StripPlan for shot_count photos. If the grid hasn't got
+        enough free cells, rows are added and every cell gets shorter."""
+        template = os.path.join(directory, self.template)
+        size = templates.load(template).size
+        rows = self.rows
+        cells = self._cells(size, rows)
+        while len(cells) < shot_count:
+            rows += 1
+            cells = self._cells(size, rows)
+        return StripPlan(template, size, cells[:shot_count], self.rotation)
+
+
+def _overlap(a, b):
+    """Whether two (x, y, width, height) boxes share any pixels"""
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+# The bundled templates, both a 2x2 grid with the bottom right cell left for the artwork.
+# For portrait the camera is mounted on its side, so photos get a quarter turn clockwise.
+# Landscape cells are landscape too, so the camera is mounted level and photos go in as shot.
+LAYOUTS = {
+    'portrait': StripLayout('photobooth_template_portrait.jpg', columns=2, rows=2, reserved=((-1, -1),),
+                            rotation=-90),
+    'landscape': StripLayout('photobooth_template.jpg', columns=2, rows=2, reserved=((-1, -1),), rotation=0),
+}
+
+
+class StripPlan(object):
+    """A compiled StripLayout: the template, and a box (x, y, width, height)
+    for each shot in order.
+
+    The resize and crop taking a photo into a slot are worked out the first
+    time a photo of that size turns up, and reused after that.
+    """
+    def __init__(self, template, size, slots, rotation=0):
+        self.template = template
+        self.size = size
+        self.slots = tuple(slots)
+        self.rotation = rotation % 360
+        self.transpose = TRANSPOSES[self.rotation]
+        self._transforms = {}
+
+    def __len__(self):
+        return len(self.slots)
+
+    @property
+    def key(self):
+        """Equal for plans that place photos the same way"""
+        return (self.template, self.size, self.slots, self.rotation)
+
+    def draft_size(self, index):
+        """Smallest decode of an unrotated photo that still covers the slot"""
+        (x, y, width, height) = self.slots[index]
+        return (height, width) if self.rotation % 180 else (width, height)
+
+    def transform(self, index, size):
+        """(resize dims, crop box) taking a rotated photo of size into slot index"""
+        slot_size = self.slots[index][2:]
+        key = (slot_size, size)
+        transform = self._transforms.get(key)
+        if transform is None:
+            # Snip the edges that stick out so it's the right proportion
+            (dims, crop) = get_resize_transform(size, slot_size)
+            box = (crop[0] // 2, crop[1] // 2, slot_size[0] + crop[0] // 2, slot_size[1] + crop[1] // 2)
+            transform = self._transforms[key] = (dims, box)
+        return transform
+
+    def scaled(self, size):
+        """The same plan shrunk to fit inside size, e.g. to draw a mock-up on screen"""
+        scale = min(float(size[0]) / self.size[0], float(size[1]) / self.size[1])
+        slots = [tuple(int(value * scale) for value in slot) for slot in self.slots]
+        return StripPlan(self.template, (int(self.size[0] * scale), int(self.size[1] * scale)), slots, self.rotation)
+
+
+def make_piece(path, plan, index):
+    """Open a photo and turn it into a piece that fits slot index of the plan.
+    The turn is a lossless transpose, so the only resample is the final resize."""
+    img = draft(PIL.Image.open(path), plan.draft_size(index))
+    if plan.transpose is not None:
+        img = img.transpose(plan.transpose)
+    (dims, box) = plan.transform(index, img.size)
+    img = img.resize(dims, resample=PIL.Image.LANCZOS)
+    return img.crop(box)
+
+
+class TemplateCache(object):
+    """Strip templates decoded once and kept in memory.
+
+    get() hands out a copy, which is a memcpy rather than a JPEG decode, so
+    a session can draw all over it. A template is decoded the first time
+    it's asked for, and again if its file's mtime has changed since.
+    """
+    def __init__(self):
+        self._templates = {}  # path -> (mtime, image)
+        self._lock = threading.Lock()
+
+    def load(self, path):
+        """The cached image for path, decoding it if it's new or has changed"""
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._templates.get(path)
+            if cached is None or cached[0] != mtime:
+                image = PIL.Image.open(path)
+                image.load()
+                cached = self._templates[path] = (mtime, image)
+            return cached[1]
+
+    def preload(self, paths):
+        for path in paths:
+            try:
+                self.load(path)
+            except (IOError, OSError) as e:
+                print('Could not load strip template {}: {}'.format(path, e))
+
+    def get(self, path):
+        return self.load(path).copy()
+
+
+# Work done in the pool's worker processes. Each worker keeps its own decoded templates, and
+# its own copy of each plan, since the one that comes with a task is a fresh unpickled copy
+# every time and whatever transforms it worked out would be thrown away with it
+_worker_templates = TemplateCache()
+_worker_plans = {}
+
+
+def _init_worker(templates):
+    _worker_templates.preload(templates)
+
+
+def render_piece(path, plan, index):
+    """Pool task: make_piece() for one shot. Returns ((mode, size, pixels), seconds)"""
+    start = time.time()
+    plan = _worker_plans.setdefault(plan.key, plan)
+    piece = make_piece(path, plan, index)
+    return ((piece.mode, piece.size, piece.tobytes()), time.time() - start)
+
+
+def compose_strip(plan, pieces, destpath):
+    """Pool task: paste the pieces ({index: (mode, size, pixels)}) onto the template
+    and save the strip and a small copy of it. Returns (paths, seconds)"""
+    start = time.time()
+    canvas = _worker_templates.get(plan.template)
+    for (index, (mode, size, pixels)) in pieces.items():
+        canvas.paste(PIL.Image.frombytes(mode, size, pixels), box=plan.slots[index][:2])
+    canvas.save(destpath)
+    (stem, ext) = os.path.splitext(destpath)
+    small = stem + SMALL_SUFFIX + ext
+    scale = float(SMALL_WIDTH) / canvas.size[0]
+    canvas.resize((SMALL_WIDTH, int(canvas.size[1] * scale)), resample=PIL.Image.LANCZOS).save(small)
+    return ({'strip': destpath, 'small': small}, time.time() - start)
+
+
+class StripJob(object):
+    """One session's strip, as handed out by StripService.session().
+
+    add() each shot as it's downloaded, or skip() it if it failed. A
+    skipped slot, or one whose photo can't be read, leaves the template
+    showing through. Once every slot has been added or skipped, the strip
+    is composed and saved.
+    """
+    def __init__(self, service, session, destpath, plan):
+        self.service = service
+        self.session = session
+        self.destpath = destpath
+        self.plan = plan
+        self._pieces = {}  # index -> future, or None for a skipped slot
+        self._composing = False
+        self._started = None
+
+    def add(self, index, filename):
+        self.service.put(('add', self, index, filename))
+
+    def skip(self, index):
+        self.service.put(('skip', self, index))
+
+
+class StripService(threading.Thread):
+    """Renders strips in a pool of worker processes.
+
+    PIL holds the GIL through most of a decode or resize, so strip work on a
+    thread still stalls the display. Here each shot is turned into its piece
+    in a worker process as soon as it lands, and once a session's pieces are
+    all in, another worker pastes them onto the template and saves the strip
+    and its derivatives. Sessions don't wait on each other, so a backlog
+    renders in parallel across the cores.
+
+    The bookkeeping runs on this thread, fed by the jobs and by the pool's
+    completion callbacks. Progress is posted as USEREVENTs: 'strip_progress'
+    (session, done, total) as each piece finishes, then 'strip_ready'
+    (session, paths) or 'strip_failed' (session, error).
+
+    stop() lets every strip that has all its shots finish first, so join()
+    the thread before quitting.
+    """
+    def __init__(self, templates=(), workers=None, timings=None):
+        super(StripService, self).__init__(name='StripService')
+        self.daemon = True
+        self.timings = timings
+        # Workers come from a forkserver, so they don't inherit the camera and display threads
+        self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver'),
+                                        initializer=_init_worker, initargs=(list(templates),))
+        self._messages = queue.Queue()
+        self._active = set()  # jobs that have had a shot and haven't finished yet
+
+    def session(self, session, destpath, plan):
+        return StripJob(self, session, destpath, plan)
+
+    def put(self, message):
+        self._messages.put(message)
+
+    def stop(self):
+        self._messages.put(None)
+
+    def _record(self, stage, seconds):
+        if self.timings is not None:
+            self.timings.record(stage, seconds)
+
+    def _post(self, action, **kwargs):
+        pygame.event.post(pygame.event.Event(pygame.USEREVENT, action=action, **kwargs))
+
+    def _failed(self, job, error):
+        print('Building strip {} failed: {}'.format(job.destpath, error))
+        job._composing = True
+        self._active.discard(job)
+        self._post('strip_failed', session=job.session, error=str(error))
+
+    def _piece_done(self, job, index, future):
+        try:
+            (piece, seconds) = future.result()
+            self._record('strip_piece', seconds)
+        except Exception as e:
+            print('Leaving slot {} of the strip empty: {}'.format(index, e))
+        done = sum(1 for f in job._pieces.values() if f is None or f.done())
+        self._post('strip_progress', session=job.session, done=done, total=len(job.plan))
+
+    def _compose(self, job):
+        """Hand the pieces over for composing, once every slot is accounted for"""
+        if job._composing or len(job._pieces) < len(job.plan):
+            return
+        if any(f is not None and not f.done() for f in job._pieces.values()):
+            return
+        job._composing = True
+        job._started = time.time()
+        pieces = {}
+        for (index, future) in job._pieces.items():
+            if future is not None and future.exception() is None:
+                pieces[index] = future.result()[0]
+        if not pieces:
+            # A bare template is no strip, don't save or send one
+            self._failed(job, 'no shots to put on the strip')
+            return
+        future = self.pool.submit(compose_strip, job.plan, pieces, job.destpath)
+        future.add_done_callback(lambda future: self.put(('composed', job, future)))
+
+    def _composed(self, job, future):
+        try:
+            (paths, seconds) = future.result()
+        except Exception as e:
+            self._failed(job, e)
+            return
+        self._record('strip_save', seconds)
+        # How long the strip took once the last shot was in, which is what people wait for
+        self._record('strip', time.time() - job._started)
+        self._active.discard(job)
+        self._post('strip_ready', session=job.session, paths=paths)
+
+    def run(self):
+        stopping = False
+        while not (stopping and not self._active):
+            message = self._messages.get()
+            if message is None:
+                # No more shots are coming, so anything still short of a shot never will finish
+                stopping = True
+                for job in [job for job in self._active if len(job._pieces) < len(job.plan)]:
+                    print('Abandoning the strip for session {}, not all of its shots arrived'.format(job.session))
+                    self._active.discard(job)
+                continue
+            (action, job) = message[:2]
+            try:
+                if action in ('add', 'skip'):
+                    self._active.add(job)
+                if action == 'add':
+                    (index, filename) = message[2:]
+                    future = self.pool.submit(render_piece, filename, job.plan, index)
+                    job._pieces[index] = future
+                    future.add_done_callback(lambda future, job=job, index=index: self.put(('piece', job, index, future)))
+                elif action == 'skip':
+                    job._pieces[message[2]] = None
+                    self._compose(job)
+                elif action == 'piece':
+                    self._piece_done(job, *message[2:])
+                    self._compose(job)
+                elif action == 'composed':
+                    self._composed(job, message[2])
+            except Exception as e:
+                self._failed(job, e)
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,156 @@
+import csv
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Stages that run on the render loop, as opposed to the preview worker
+RENDER_STAGES = ('transform', 'effects', 'text', 'flip')
+PREVIEW_STAGES = ('capture', 'decode')
+QUALITY_STEPS = (1.0, 0.5, 0.25)
+# Upper edges of the histogram buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf'))
+
+
+class Timings(object):
+    """Named timing spans feeding rolling histograms.
+
+    Every stage keeps its last `window` samples for the histogram and
+    percentiles, plus a moving average for anything that needs to react to
+    the current load. Safe to record into from any thread.
+    """
+    def __init__(self, window=500, smoothing=0.2):
+        self.window = window
+        self.smoothing = smoothing
+        self._samples = {}
+        self._averages = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(maxlen=self.window)
+                self._averages[stage] = seconds
+                self._counts[stage] = 0
+            samples.append(seconds)
+            self._averages[stage] += self.smoothing * (seconds - self._averages[stage])
+            self._counts[stage] += 1
+
+    @contextmanager
+    def span(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - start)
+
+    def average(self, *stages):
+        with self._lock:
+            return sum(self._averages.get(stage, 0.0) for stage in stages)
+
+    def stages(self):
+        with self._lock:
+            return list(self._samples.keys())
+
+    def summary(self, stage):
+        """Returns (count, mean, p50, p95, max, histogram) for a stage, times in milliseconds"""
+        with self._lock:
+            samples = sorted(self._samples[stage])
+            count = self._counts[stage]
+        samples = [sample * 1000 for sample in samples]
+        histogram = [0] * len(BUCKETS)
+        bucket = 0
+        for sample in samples:
+            while sample > BUCKETS[bucket]:
+                bucket += 1
+            histogram[bucket] += 1
+        return (count,
+                sum(samples) / len(samples),
+                samples[len(samples) // 2],
+                samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                samples[-1],
+                histogram)
+
+    def hud_lines(self):
+        lines = ['{:<14}{:>8}{:>8}{:>8}{:>8}'.format('stage (ms)', 'mean', 'p50', 'p95', 'max')]
+        for stage in sorted(self.stages()):
+            (count, mean, p50, p95, peak, histogram) = self.summary(stage)
+            lines.append('{:<14}{:>8.1f}{:>8.1f}{:>8.1f}{:>8.1f}'.format(stage, mean, p50, p95, peak))
+        return lines
+
+    def dump_csv(self, path):
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'max_ms'] +
+                            ['le_{}ms'.format(edge) for edge in BUCKETS])
+            for stage in sorted(self.stages()):
+                (count, mean, p50, p95, peak, histogram) = self.summary(stage)
+                writer.writerow([stage, count, '{:.3f}'.format(mean), '{:.3f}'.format(p50),
+                                 '{:.3f}'.format(p95), '{:.3f}'.format(peak)] + histogram)
+
+
+class FrameGovernor(object):
+    """Picks the tick rate and preview quality from measured stage timings.
+
+    From the moving averages in `timings` the governor works out the fastest
+    frame rate that still leaves `headroom` of each frame idle, and drops the
+    preview decode quality when decoding can't keep up.
+    """
+    def __init__(self, timings, target_fps=30, headroom=0.25, min_fps=2, adjust_interval=2.0):
+        self.timings = timings
+        self.target_fps = target_fps
+        self.headroom = headroom
+        self.min_fps = min_fps
+        self.adjust_interval = adjust_interval
+        self.quality_index = 0
+        self._last_adjust = time.time()
+
+    def average(self, *stages):
+        return self.timings.average(*stages)
+
+    @property
+    def frame_budget(self):
+        """Seconds of work allowed per frame at the target rate, after headroom"""
+        return (1.0 - self.headroom) / self.target_fps
+
+    @property
+    def quality(self):
+        return QUALITY_STEPS[self.quality_index]
+
+    @property
+    def fps(self):
+        fps = self.target_fps
+        render_time = self.average(*RENDER_STAGES)
+        if render_time > 0:
+            fps = min(fps, (1.0 - self.headroom) / render_time)
+        preview_time = self.average(*PREVIEW_STAGES)
+        if preview_time > 0:
+            # No point drawing faster than new frames turn up
+            fps = min(fps, 1.0 / preview_time)
+        return max(self.min_fps, fps)
+
+    @property
+    def effect_budget(self):
+        """What's left of the frame budget once everything but the effects is paid for"""
+        other = self.average(*RENDER_STAGES) - self.average('effects')
+        return max(0.0, self.frame_budget - other)
+
+    def adjust(self):
+        """Step the preview quality up or down. Returns True if it changed"""
+        now = time.time()
+        if now - self._last_adjust < self.adjust_interval:
+            return False
+        self._last_adjust = now
+        # Only the decode scales with quality. Capture is USB time (and waiting on the camera
+        # lock), a smaller decode can't buy any of that back, so it only caps the frame rate
+        decode_time = self.average('decode')
+        if decode_time > self.frame_budget and self.quality_index < len(QUALITY_STEPS) - 1:
+            self.quality_index += 1
+            return True
+        elif decode_time < self.frame_budget / 4 and self.quality_index > 0:
+            # Each step up is roughly four times the decode work, so leave a wide margin
+            self.quality_index -= 1
+            return True
+        return False